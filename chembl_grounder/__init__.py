@@ -1,5 +1,8 @@
 from .chembl_grounder import ChemblGrounder
 from .chembl_name_db import ChemblNameDB
 from .chembl_name_index import ChemblNameIndex
+from .chembl_source import OracleSource, SnapshotSource, SqliteSource
 from .chembl_structure_index import ChemblStructureIndex
 from .gsrs_index import GsrsIndex
+from .gsrs_store import GsrsStore
+from .structure_cache import StructureCache
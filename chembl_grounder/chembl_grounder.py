@@ -9,8 +9,13 @@ from . import chembl_name_index as cni
 from . import chembl_structure_index as csi
 
 class ChemblGrounder():
-    def __init__(self, data_dir='.', chembl_index=None, gsrs_index=None, structure_index=None, chembl_name_index=None):
+    def __init__(self, data_dir='.', chembl_index=None, gsrs_index=None, structure_index=None, chembl_name_index=None, gsrs_backend='json', code_source='unichem', unichem_timeout=30, fuzzy_names=False, fuzzy_name_distance=2):
         self.data_dir = data_dir
+        self.fuzzy_names = fuzzy_names  # add approximate name matches as 'fuzzy_name' evidence, ranked below exact names, needs ChemblNameIndex.gen_fuzzy_index
+        self.fuzzy_name_distance = fuzzy_name_distance
+        self.code_source = code_source  # 'unichem' queries the UniChem REST API, 'gsrs' uses the offline GSRS code index
+        self.unichem_timeout = unichem_timeout
+        self.unichem_session = requests.Session()
         
         if chembl_index is None:
             self.chembl_index = chembl_ident.ChemblIndexes(data_dir=self.data_dir)
@@ -18,7 +23,7 @@ class ChemblGrounder():
             self.chembl_index = chembl_index
             
         if gsrs_index is None:
-            self.gsrs_index = gi.GsrsIndex(data_dir=self.data_dir)
+            self.gsrs_index = gi.GsrsIndex(data_dir=self.data_dir, backend=gsrs_backend)
         else:
             self.gsrs_index = gsrs_index
         
@@ -33,7 +38,7 @@ class ChemblGrounder():
             self.chembl_name_index = chembl_name_index
         self.chembl_name_index.connect_to_namestore(create=True)
         
-        self.caches = {'unichem': {}, 'name': {}, 'structure': {}}
+        self.caches = {'unichem': {}, 'gsrs_code': {}, 'name': {}, 'fuzzy_name': {}, 'structure': {}}
         
         
     def pick_top_evidence(self, evidence):
@@ -41,6 +46,7 @@ class ChemblGrounder():
             'structure': 0,
             'code': 1, 
             'name': 2, 
+            'fuzzy_name': 3, 
         }
         code_rank = {
             'gsrs': 0, 
@@ -80,6 +86,15 @@ class ChemblGrounder():
             top, score = sorted(data, key=lambda x:x[1])[0]
             return top, score
 
+        if t == "fuzzy_name":
+            data = [(x,(type_rank[t],
+                        x[-1]['distance'],  # closest name first
+                        len(x),
+                        name_rank[x[-1]['source']],
+                        len(x[0]['link_data']))) for x in es]
+            top, score = sorted(data, key=lambda x:x[1])[0]
+            return top, score
+
         if t == "structure":
             data = [(x,(type_rank[t],
                         len(x),
@@ -121,7 +136,7 @@ class ChemblGrounder():
         return 100
 
     def lookup_ingredient_unichem(self, code, src_id=14):
-        response = requests.get(f'https://www.ebi.ac.uk/unichem/rest/src_compound_id/{code}/{src_id}')
+        response = self.unichem_session.get(f'https://www.ebi.ac.uk/unichem/rest/src_compound_id/{code}/{src_id}', timeout=self.unichem_timeout)
         rs = json.loads(response.text)
         data = defaultdict(list)
         for r in rs:
@@ -131,6 +146,11 @@ class ChemblGrounder():
         if 1 in data:
             return data[1][0]
 
+    def lookup_ingredient_gsrs_code(self, unii):
+        chembl_ids = self.gsrs_index.get_chembl_ids(unii)
+        if chembl_ids:
+            return chembl_ids[0]
+
     def lookup_ingredient_structure(self, unii, filter_layers={'q', 'i', 'f', 'p', 't', 'm', 'b', 's'}):
         results = []
         try:
@@ -150,9 +170,16 @@ class ChemblGrounder():
 
         return gsrs_inchi, results
 
-    def lookup_ingredient_name(self, name, unii):
-        results = defaultdict(lambda :defaultdict(set))
+    def suggest_similar(self, unii, k=10, threshold=0.0):
+        # ranked fingerprint similarity suggestions for a UNII, kept apart from the match evidence
+        try:
+            gsrs_inchi = self.gsrs_index.get_inchi(unii)['standardised']
+        except:
+            return None
+        
+        return self.structure_index.query_similar(gsrs_inchi, k=k, threshold=threshold)
 
+    def ingredient_names(self, name, unii):
         names = {(name,'spl')}
         try:
             gsrs_data = self.gsrs_index.query(unii)
@@ -161,6 +188,13 @@ class ChemblGrounder():
                 names.update(gsrs_names)
         except:
             pass
+        
+        return names
+    
+    def lookup_ingredient_name(self, name, unii):
+        results = defaultdict(lambda :defaultdict(set))
+
+        names = self.ingredient_names(name, unii)
 
         for n, name_type in names:
             r = self.chembl_name_index.query_name(n, filter_name=True)
@@ -172,6 +206,22 @@ class ChemblGrounder():
         
         results = {k1:{k2:v2 for k2,v2 in v1.items()} for k1,v1 in results.items()}
         return results
+    
+    def lookup_ingredient_fuzzy_name(self, name, unii):
+        # as lookup_ingredient_name, but {chembl_ident: {matched name: (name types, distance)}} for names the exact lookup doesn't find
+        results = defaultdict(dict)
+
+        for n, name_type in self.ingredient_names(name, unii):
+            r = self.chembl_name_index.query_name_fuzzy(n, max_distance=self.fuzzy_name_distance, exclude_exact=True)  # exact matches are name evidence
+            if r:
+                for v in r:
+                    s = v['substance']
+                    n = (v['name']['name'], v['name']['type'], v['name']['table'])
+                    name_types, distance = results[s].get(n, (set(), v['distance']))
+                    name_types.add(name_type)
+                    results[s][n] = (name_types, min(distance, v['distance']))
+        
+        return dict(results)
 
     def get_pref_chembl_compound(self, ci):
         candidates = {ci}
@@ -205,6 +255,34 @@ class ChemblGrounder():
 
         return top_chembl_ident, candidates
     
+    def name_evidence(self, unii, chembl_ident, name_match, name_types):
+        # get the preferred ChEMBL identifier
+        chembl_code_type, chembl_code = next(
+            ((t,i) for t,i in [
+                ("drugbase_id",chembl_ident.drugbase_id), 
+                ("chembl_id",chembl_ident.chembl_id), 
+                ("molregno",chembl_ident.molregno)
+            ] if not i is None), 
+            None
+        )
+
+        match_name, match_name_type, match_name_table = name_match
+        name_type = sorted(list(name_types), key=self.rank_name_types)[0]
+
+        if name_type == 'spl':
+            evidence_dict = [
+                {'source': 'spl', 'link_type': 'name', 'link_data': match_name}, 
+                {'source': match_name_table, 'link_type': chembl_code_type, 'link_data': chembl_code}
+            ]
+        else:
+            evidence_dict = [
+                {'source': 'spl', 'link_type': 'unii', 'link_data': unii}, 
+                {'source': 'gsrs', 'link_type': name_type, 'link_data': name_match}, 
+                {'source': match_name_table, 'link_type': chembl_code_type, 'link_data': chembl_code}
+            ]
+        
+        return evidence_dict
+    
     def query(self, name, unii, filter_layers={'q', 'i', 'f', 'p', 't', 'm', 'b', 's'}, cache={}):
         ingredient_matches_evidence = defaultdict(lambda :defaultdict(list))
 
@@ -228,15 +306,20 @@ class ChemblGrounder():
                 ]
                 ingredient_matches_evidence[chembl_ident]['structure'].append(evidence_dict)
 
-        # UniChem code matches
-        if not unii in self.caches['unichem']:
-            self.caches['unichem'][unii] = self.lookup_ingredient_unichem(unii)
-        unichem_match = self.caches['unichem'][unii]
+        # code matches, from UniChem or the offline GSRS code index
+        if self.code_source == 'gsrs':
+            if not unii in self.caches['gsrs_code']:
+                self.caches['gsrs_code'][unii] = self.lookup_ingredient_gsrs_code(unii)
+            code_match = self.caches['gsrs_code'][unii]
+        else:
+            if not unii in self.caches['unichem']:
+                self.caches['unichem'][unii] = self.lookup_ingredient_unichem(unii)
+            code_match = self.caches['unichem'][unii]
 
-        if unichem_match:
-            chembl_id = unichem_match
+        if code_match:
+            chembl_id = code_match
             chembl_ident = self.chembl_index.get_chembl_ident(chembl_id=chembl_id)
-            evidence_dict = [{'source': 'spl', 'link_type': 'unii', 'link_data': unii}, {'source': 'unichem', 'link_type': 'chembl_id', 'link_data': chembl_id}]
+            evidence_dict = [{'source': 'spl', 'link_type': 'unii', 'link_data': unii}, {'source': self.code_source, 'link_type': 'chembl_id', 'link_data': chembl_id}]
             ingredient_matches_evidence[chembl_ident]['code'].append(evidence_dict)
 
         # Name matches
@@ -246,34 +329,20 @@ class ChemblGrounder():
 
         if name_matches:
             for chembl_ident,matched_names in name_matches.items():
-
-                # get the preferred ChEMBL identifier
-                chembl_code_type, chembl_code = next(
-                    ((t,i) for t,i in [
-                        ("drugbase_id",chembl_ident.drugbase_id), 
-                        ("chembl_id",chembl_ident.chembl_id), 
-                        ("molregno",chembl_ident.molregno)
-                    ] if not i is None), 
-                    None
-                )
-
                 for name_match, name_types in matched_names.items():
-                    match_name, match_name_type, match_name_table = name_match
-                    name_type = sorted(list(name_types), key=self.rank_name_types)[0]
-
-                    if name_type == 'spl':
-                        evidence_dict = [
-                            {'source': 'spl', 'link_type': 'name', 'link_data': match_name}, 
-                            {'source': match_name_table, 'link_type': chembl_code_type, 'link_data': chembl_code}
-                        ]
-                    else:
-                        evidence_dict = [
-                            {'source': 'spl', 'link_type': 'unii', 'link_data': unii}, 
-                            {'source': 'gsrs', 'link_type': name_type, 'link_data': name_match}, 
-                            {'source': match_name_table, 'link_type': chembl_code_type, 'link_data': chembl_code}
-                        ]
-
-                    ingredient_matches_evidence[chembl_ident]['name'].append(evidence_dict)
+                    ingredient_matches_evidence[chembl_ident]['name'].append(self.name_evidence(unii, chembl_ident, name_match, name_types))
+        
+        # approximate name matches
+        if self.fuzzy_names:
+            if not (name, unii) in self.caches['fuzzy_name']:
+                self.caches['fuzzy_name'][(name, unii)] = self.lookup_ingredient_fuzzy_name(name, unii)
+            fuzzy_name_matches = self.caches['fuzzy_name'][(name, unii)]
+            
+            for chembl_ident,matched_names in fuzzy_name_matches.items():
+                for name_match, (name_types, distance) in matched_names.items():
+                    evidence_dict = self.name_evidence(unii, chembl_ident, name_match, name_types)
+                    evidence_dict[-1]['distance'] = distance
+                    ingredient_matches_evidence[chembl_ident]['fuzzy_name'].append(evidence_dict)
         
         ingredient_matches_evidence = {k1:{k2:v2 for k2,v2 in v1.items()} for k1,v1 in ingredient_matches_evidence.items()}
 
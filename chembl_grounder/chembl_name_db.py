@@ -11,8 +11,47 @@ class ChemblNameDB():
         self.engine = sa.create_engine(self.db_path)  # pool_recycle=3600
         self.SessionMaker = sa.orm.sessionmaker(bind=self.engine)
         
-    def create(self):
-        self.Base.metadata.create_all(self.engine)
+    def create(self, indexes=True):
+        if indexes:
+            self.Base.metadata.create_all(self.engine)
+            self.create_indexes()  # indexes added to the schema since an existing store was created
+            self.create_fts()
+            return
+        
+        # tables only, for bulk loads, the indexes are added with create_indexes
+        existing = set(sa.inspect(self.engine).get_table_names())
+        with self.engine.begin() as connection:
+            for table in self.Base.metadata.sorted_tables:
+                if not table.name in existing:
+                    connection.execute(sa.schema.CreateTable(table))
+        self.create_fts()
+    
+    def create_fts(self):
+        # FTS5 token index over name.lower, an external content table so the names aren't stored twice
+        with self.engine.begin() as connection:
+            connection.execute(sa.text("create virtual table if not exists name_fts using fts5(lower, content='name', content_rowid='id')"))
+    
+    def populate_fts(self):
+        # re-read name into the token index, run after names are loaded
+        with self.engine.begin() as connection:
+            connection.execute(sa.text("insert into name_fts(name_fts) values('rebuild')"))
+    
+    def existing_indexes(self, table):
+        return {index['name'] for index in sa.inspect(self.engine).get_indexes(table.name)}
+    
+    def create_indexes(self):
+        for table in self.Base.metadata.sorted_tables:
+            existing = self.existing_indexes(table)
+            for index in table.indexes:
+                if not index.name in existing:
+                    index.create(self.engine)
+    
+    def drop_indexes(self):
+        for table in self.Base.metadata.sorted_tables:
+            existing = self.existing_indexes(table)
+            for index in table.indexes:
+                if index.name in existing:
+                    index.drop(self.engine)
         
     def drop_all(self):
         self.Base.metadata.drop_all(self.engine)
@@ -71,7 +110,7 @@ class ChemblNameDB():
         __table_args__ = (sa.Index('substance2name_substanceid_nameid_idx', 'substance_id', "name_id", unique=True), )
         
         substance_id = sa.Column(sa.Integer, sa.ForeignKey("substance.id"), primary_key=True)
-        name_id = sa.Column(sa.Integer, sa.ForeignKey("name.id"), primary_key=True)
+        name_id = sa.Column(sa.Integer, sa.ForeignKey("name.id"), primary_key=True, index=True)  # postings of a name, the composite index leads with substance_id
         
         substance = sa.orm.relationship("Substance", back_populates="name_assocs", cascade="save-update, merge")
         name = sa.orm.relationship("Name", back_populates="substance_assocs", cascade="save-update, merge")
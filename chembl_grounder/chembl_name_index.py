@@ -1,6 +1,7 @@
 # import json
 import pickle
 import re
+import time
 from collections import defaultdict
 from tqdm.auto import tqdm
 import cx_Oracle
@@ -9,6 +10,8 @@ import sqlite3
 
 import chembl_ident
 from .chembl_name_db import ChemblNameDB
+from . import chembl_source
+from .fuzzy_name_index import FuzzyNameIndex
 
 
 class ChemblNameIndex():
@@ -19,6 +22,11 @@ class ChemblNameIndex():
         self.name_store = None
         self.name_session = None
         
+        self.name_table = None  # name id -> {'name', 'type', 'table'}, see load_name_tables
+        self.substance_table = None  # substance id -> ChemblIdent
+        self.substance_idents = {}  # substance id -> ChemblIdent, resolved postings
+        self.fuzzy_index = None  # optional approximate name matching, see gen_fuzzy_index
+        
         if chembl_index is None:
             self.chembl_index = chembl_ident.ChemblIndexes(data_dir=self.data_dir)
         else:
@@ -46,119 +54,141 @@ class ChemblNameIndex():
         
         return self.name_store
 
-    def fetch_chembl_data(self):
-        if self.chembl_db is None:
-            self.connect_to_chembl()
-            
-        chembl_cursor = self.chembl_db.cursor()
-        
-        sql_query = (   
-                        "select MD.ID, MD.MOLREGNO, MD.PREF_NAME "
-                        "from DRUGBASE.MOLECULE_DICTIONARY MD "
-                        "where MD.DELETED = 0 "
-                    )
-        chembl_cursor.execute(sql_query)
+    def fetch_chembl_data(self, source=None):
+        # source is an OracleSource (default, on the current connection), SqliteSource or SnapshotSource
+        if source is None:
+            if self.chembl_db is None:
+                self.connect_to_chembl()
+            source = chembl_source.OracleSource(self.chembl_db)
         
         self.pref_names = []
-        for drugbase_id, molregno, pref_name in tqdm(chembl_cursor, desc='Drugbase preferred names'):
+        for drugbase_id, molregno, pref_name in tqdm(source.rows('drugbase_pref_names'), desc='Drugbase preferred names'):
             if pref_name == "NA":
                 continue
             self.pref_names.append((drugbase_id, molregno, pref_name))
-
-        sql_query = (   
-                        "select MD.ID, MD.MOLREGNO, MS.NAME, MST.NAME "
-                        "from DRUGBASE.MOLECULE_SYNONYM MS "
-                        "left join DRUGBASE.MOLECULE_SYNONYM_TYPE MST "
-                        "on MS.MOLECULE_SYNONYM_TYPE_ID = MST.ID "
-                        "left join DRUGBASE.MOLECULE_DICTIONARY MD "
-                        "on MS.MOLECULE_DICTIONARY_ID = MD.ID "
-                        "where MD.DELETED = 0 "
-                    )
-
-        chembl_cursor.execute(sql_query)
         
         self.mol_syns = []
-        for drugbase_id, molregno, name, name_type in tqdm(chembl_cursor, desc='Drugbase molecule synonyms'):
+        for drugbase_id, molregno, name, name_type in tqdm(source.rows('drugbase_synonyms'), desc='Drugbase molecule synonyms'):
             self.mol_syns.append((drugbase_id, molregno, name, name_type))
-
-        sql_query = (   
-                        "select MD.ID, MD.MOLREGNO, MCN.NAME "
-                        "from DRUGBASE.MOLECULE_CHEMICAL_NAME MCN "
-                        "left join DRUGBASE.MOLECULE_DICTIONARY MD "
-                        "on MCN.MOLECULE_DICTIONARY_ID = MD.ID "
-                        "where MD.DELETED = 0 "
-                    )
-        chembl_cursor.execute(sql_query)
         
         self.chem_names = []
-        for drugbase_id, molregno, name in tqdm(chembl_cursor, desc='Drugbase molecule chemical names'):
+        for drugbase_id, molregno, name in tqdm(source.rows('drugbase_chemical_names'), desc='Drugbase molecule chemical names'):
             if name:
-                name = name.read()
+                name = chembl_source.read_lob(name)
             self.chem_names.append((drugbase_id, molregno, name))
-
-        sql_query = (   
-                        "select DC.MOLECULE_DICTIONARY_ID, DC.MOLREGNO, DC.DAILYMED_INGREDIENT "
-                        "from DRUGBASE.DAILYMED_COMPOUNDS DC "
-                    )
-
-        chembl_cursor.execute(sql_query)
         
         self.dm_names = []
-        for drugbase_id,molregno,dm_ingr in tqdm(chembl_cursor, desc='Drugbase DailyMed ingredient names'):
+        for drugbase_id,molregno,dm_ingr in tqdm(source.rows('drugbase_dailymed_names'), desc='Drugbase DailyMed ingredient names'):
             self.dm_names.append((drugbase_id,molregno,dm_ingr))
-
-        sql_query = (   
-                        "select MD.CHEMBL_ID, MD.MOLREGNO, MD.PREF_NAME "
-                        "from CHEMBL.MOLECULE_DICTIONARY MD "
-                    )
-        chembl_cursor.execute(sql_query)
         
         self.chembl_pref_names = []
-        for chembl_id,mrn,pref_name in tqdm(chembl_cursor, desc='ChEMBL preferred names'):
+        for chembl_id,mrn,pref_name in tqdm(source.rows('chembl_pref_names'), desc='ChEMBL preferred names'):
             if pref_name == "NA":
                 continue
             self.chembl_pref_names.append((chembl_id,mrn,pref_name))
-
-        sql_query = (   
-                        "select MD.CHEMBL_ID, MS.MOLREGNO, MS.SYNONYMS "
-                        "from CHEMBL.MOLECULE_SYNONYMS MS "
-                        "left join CHEMBL.MOLECULE_DICTIONARY MD "
-                        "on MS.MOLREGNO = MD.MOLREGNO"
-                    )
-        chembl_cursor.execute(sql_query)
         
         self.chembl_mol_syns = []
-        for chembl_id,mrn,synonyms in tqdm(chembl_cursor, desc='ChEMBL molecule synonyms'):
+        for chembl_id,mrn,synonyms in tqdm(source.rows('chembl_synonyms'), desc='ChEMBL molecule synonyms'):
             self.chembl_mol_syns.append((chembl_id,mrn,synonyms))
-
-        sql_query = (   
-                        "select MD.CHEMBL_ID, CR.MOLREGNO, CR.COMPOUND_NAME "
-                        "from CHEMBL.COMPOUND_RECORDS CR "
-                        "left join CHEMBL.MOLECULE_DICTIONARY MD "
-                        "on CR.MOLREGNO = MD.MOLREGNO"
-                    )
-        chembl_cursor.execute(sql_query)
         
         self.chembl_compound_names = []
-        for chembl_id,mrn,compound_name in tqdm(chembl_cursor, desc='ChEMBL compound names'):
+        for chembl_id,mrn,compound_name in tqdm(source.rows('chembl_compound_names'), desc='ChEMBL compound names'):
             self.chembl_compound_names.append((chembl_id,mrn,compound_name))
-
-        sql_query = (   
-                        "select MD.CHEMBL_ID, FO.MOLREGNO, PR.TRADE_NAME "
-                        "from CHEMBL.FORMULATIONS FO left join CHEMBL.PRODUCTS PR "
-                        "on FO.PRODUCT_ID = PR.PRODUCT_ID "
-                        "left join CHEMBL.MOLECULE_DICTIONARY MD "
-                        "on FO.MOLREGNO = MD.MOLREGNO"
-                    )
-        chembl_cursor.execute(sql_query)
         
         self.chembl_trade_names = []
-        for chembl_id,mrn,trade_name in tqdm(chembl_cursor, desc='ChEMBL trade names'):
+        for chembl_id,mrn,trade_name in tqdm(source.rows('chembl_trade_names'), desc='ChEMBL trade names'):
             self.chembl_trade_names.append((chembl_id,mrn,trade_name))
             
-        chembl_cursor.close()
+    def source_names(self):
+        # (ChemblIdent, name, table, name type, associate) for every fetched source row, each ident is resolved once
+        allowed_syn_types = {'USAN', 'USAN_R', 'INN', 'INN_R', 'USP', 'BAN', 'ATC', 'FDA', 'NF', 'MI', 'JAN', 'DCF', 'WHO-DD', 'BN_USP', 'BNF', 'CTGOV', 'TN', 'BN'}
+        
+        for db_id,mrn,name in self.pref_names:
+            yield self.chembl_index.get_chembl_ident(drugbase_id=db_id, molregno=mrn, chembl_id=None), name, "drugbase pref", None, True
+        for db_id,mrn,name,name_type in self.mol_syns:
+            yield self.chembl_index.get_chembl_ident(drugbase_id=db_id, molregno=mrn, chembl_id=None), name, "drugbase syn", name_type, name_type in allowed_syn_types
+        for db_id,mrn,name in self.chem_names:
+            yield self.chembl_index.get_chembl_ident(drugbase_id=db_id, molregno=mrn, chembl_id=None), name, "drugbase chem", None, True
+        for db_id,mrn,name in self.dm_names:
+            yield self.chembl_index.get_chembl_ident(drugbase_id=db_id, molregno=mrn, chembl_id=None), name, "drugbase dm", None, True
+        for chembl_id,mrn,name in self.chembl_pref_names:
+            yield self.chembl_index.get_chembl_ident(drugbase_id=None, molregno=mrn, chembl_id=chembl_id), name, "chembl pref", None, True
+        for chembl_id,mrn,name in self.chembl_mol_syns:
+            yield self.chembl_index.get_chembl_ident(drugbase_id=None, molregno=mrn, chembl_id=chembl_id), name, "chembl syn", None, True
+        for chembl_id,mrn,name in self.chembl_compound_names:
+            yield self.chembl_index.get_chembl_ident(drugbase_id=None, molregno=mrn, chembl_id=chembl_id), name, "chembl compound", None, True
+        for chembl_id,mrn,name in self.chembl_trade_names:
+            yield self.chembl_index.get_chembl_ident(drugbase_id=None, molregno=mrn, chembl_id=chembl_id), name, "chembl trade", None, True
+    
+    def bulk_save_to_db(self, batch_size=100000):
+        # same rows as save_to_db, loaded in one transaction with the secondary indexes created after the load
+        # returns {table: {'rows', 'seconds', 'rows_per_sec'}}
+        if self.name_store is None:
+            self.connect_to_namestore()
+        
+        source_rows = list(tqdm(self.source_names(), leave=True, position=0, desc='Resolving substances'))
+        
+        substance_index = {ci for ci, name, table, name_type, associate in source_rows} - {None}
+        substance_index = {ci:i for i,ci in enumerate(substance_index)}
+        name_index = {(name, table, name_type) for ci, name, table, name_type, associate in source_rows if name}
+        name_index = {n:i for i,n in enumerate(name_index)}
+        assocs = {(substance_index[ci], name_index[(name, table, name_type)]) for ci, name, table, name_type, associate in source_rows if name and associate and (not ci is None)}
+        
+        tables = [
+            ('substance', "insert into substance (id, molregno, drugbase_id, chembl_id) values (?, ?, ?, ?)", 
+             [(i, ci.molregno, ci.drugbase_id, ci.chembl_id) for ci,i in substance_index.items()]),
+            ('name', 'insert into name (id, name, "table", type, lower) values (?, ?, ?, ?, ?)', 
+             [(i, name, table, name_type, name.lower()) for (name, table, name_type),i in name_index.items()]),
+            ('substance2name', "insert into substance2name (substance_id, name_id) values (?, ?)", 
+             list(assocs)),
+        ]
+        
+        self.name_store.create(indexes=False)
+        
+        stats = {}
+        connection = self.name_store.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            for table, sql, rows in tables:
+                if cursor.execute(f"select exists (select 1 from {table})").fetchone()[0]:
+                    raise ValueError(f"Bulk load needs an empty name store, {table} already has rows")
+            self.name_store.drop_indexes()
             
-    def save_to_db(self, batch_size=1000):
+            # the journal is kept in memory rather than turned off, so a failed load can still be rolled back
+            pragmas = {p:cursor.execute(f"pragma {p}").fetchone()[0] for p in ['journal_mode', 'synchronous', 'temp_store']}
+            cursor.execute("pragma journal_mode = memory")
+            cursor.execute("pragma synchronous = off")
+            cursor.execute("pragma temp_store = memory")
+            try:
+                cursor.execute("begin")
+                for table, sql, rows in tables:
+                    start = time.time()
+                    for n in tqdm(range(0, len(rows), batch_size), position=0, leave=True, desc=table.capitalize()):
+                        cursor.executemany(sql, rows[n:n+batch_size])
+                    seconds = time.time() - start
+                    stats[table] = {'rows': len(rows), 'seconds': seconds, 'rows_per_sec': len(rows) / seconds if seconds else None}
+                connection.commit()
+            except:
+                connection.rollback()
+                self.name_store.create_indexes()
+                raise
+            finally:
+                for p,v in pragmas.items():
+                    cursor.execute(f"pragma {p} = {v}")
+        finally:
+            connection.close()
+        
+        start = time.time()
+        self.name_store.create_indexes()
+        self.name_store.populate_fts()
+        stats['indexes'] = {'seconds': time.time() - start}
+        
+        return stats
+    
+    def save_to_db(self, batch_size=1000, bulk=False):
+        if bulk:
+            return self.bulk_save_to_db(batch_size=batch_size)
+        
         def batch(iterable, n=1):
             l = len(iterable)
             for ndx in range(0, l, n):
@@ -303,6 +333,8 @@ class ChemblNameIndex():
 
         name_session.commit()
         name_session.close()
+        
+        self.name_store.populate_fts()
     
     def close():
         self.name_session.close()
@@ -313,46 +345,97 @@ class ChemblNameIndex():
     def get_name(self, name_id):
         return self.name_session.query(self.name_store.Name).get(name_id)
     
-    def gen_query_index(self):
-        def get_substance(substance_id):
-            if not substance_id in substance_cache:
-                substance_cache[substance_id] = name_session.query(self.name_store.Substance).get(substance_id)
-            return substance_cache[substance_id]
+    def load_name_tables(self):
+        # hold the name and substance tables in memory so postings resolve without SQLite round trips
+        if self.name_store is None:
+            self.connect_to_namestore()
         
-        def get_name(name_id):
-            if not name_id in name_cache:
-                name_cache[name_id] = name_session.query(self.name_store.Name).get(name_id)
-            return name_cache[name_id]
+        Name = self.name_store.Name
+        Substance = self.name_store.Substance
         
+        self.name_table = {}
+        for name_id, name, name_type, table in tqdm(self.name_session.query(Name.id, Name.name, Name.type, Name.table).yield_per(100000), leave=True, position=0, desc='Names'):
+            self.name_table[name_id] = {'name': name, 'type': name_type, 'table': table}
+        
+        self.substance_table = {}
+        for substance_id, drugbase_id, molregno, chembl_id in tqdm(self.name_session.query(Substance.id, Substance.drugbase_id, Substance.molregno, Substance.chembl_id).yield_per(100000), leave=True, position=0, desc='Substances'):
+            self.substance_table[substance_id] = self.chembl_index.get_chembl_ident(drugbase_id=drugbase_id, molregno=molregno, chembl_id=chembl_id)
+        self.substance_idents = self.substance_table
+    
+    def get_names(self, name_ids):
+        # {name id: name dict}, from the in-memory table or one batched query
+        if not self.name_table is None:
+            return {i:self.name_table[i] for i in name_ids if i in self.name_table}
+        
+        Name = self.name_store.Name
+        return {
+            name_id:{'name': name, 'type': name_type, 'table': table} 
+            for name_id, name, name_type, table in self.name_session.query(Name.id, Name.name, Name.type, Name.table).filter(Name.id.in_(list(name_ids)))
+        }
+    
+    def get_substance_idents(self, substance_ids):
+        # {substance id: ChemblIdent}, idents are cached so each substance is fetched and resolved once
+        missing = [i for i in set(substance_ids) if not i in self.substance_idents]
+        if missing and (self.substance_table is None):
+            Substance = self.name_store.Substance
+            for substance_id, drugbase_id, molregno, chembl_id in self.name_session.query(Substance.id, Substance.drugbase_id, Substance.molregno, Substance.chembl_id).filter(Substance.id.in_(missing)):
+                self.substance_idents[substance_id] = self.chembl_index.get_chembl_ident(drugbase_id=drugbase_id, molregno=molregno, chembl_id=chembl_id)
+        return {i:self.substance_idents[i] for i in substance_ids if i in self.substance_idents}
+    
+    def gen_query_index(self, batch_size=100000):
+        # one streamed substance2name-name-substance join ordered by lower name, so each name is filtered once and rows are never held as ORM objects
         if self.name_store is None:
             self.connect_to_namestore()
 
         name_session = self.name_store.SessionMaker()
         
-        name_cache = {}
-        substance_cache = {}
-            
-        self.name2substances = defaultdict(set)
+        Substance2Name = self.name_store.Substance2Name
+        Name = self.name_store.Name
+        Substance = self.name_store.Substance
+        
+        q = name_session.query(
+                Substance2Name.name_id, Substance2Name.substance_id, Name.lower, 
+                Substance.drugbase_id, Substance.molregno, Substance.chembl_id
+            ).join(Name, Substance2Name.name_id == Name.id)\
+            .join(Substance, Substance2Name.substance_id == Substance.id)\
+            .filter(Name.lower.isnot(None))\
+            .order_by(Name.lower)\
+            .execution_options(stream_results=True)\
+            .yield_per(batch_size)
+        
+        self.name2substances = {}
         self.substance2names = defaultdict(set)
-        for substance2name in tqdm(name_session.query(self.name_store.Substance2Name).all(), leave=True, position=0, desc='Generating query indexes'):
-            name = get_name(substance2name.name_id)
-            substance = get_substance(substance2name.substance_id)
-            if name.lower:
-                self.name2substances[name.lower].add((substance2name.name_id, substance2name.substance_id))
-                ci = self.chembl_index.get_chembl_ident(drugbase_id=substance.drugbase_id, molregno=substance.molregno, chembl_id=substance.chembl_id)
-                self.substance2names[ci].add((substance2name.name_id, substance2name.substance_id))
-        self.name2substances = dict(self.name2substances)
+        self.filtered_name2substances = defaultdict(set)
+        self.name_table = None  # the name store may have been rebuilt
+        self.substance_table = None
+        self.substance_idents = {}
+        
+        current_lower = None
+        current_filtered = None
+        for name_id, substance_id, lower, drugbase_id, molregno, chembl_id in tqdm(q, leave=True, position=0, desc='Generating query indexes'):
+            if not lower:
+                continue
+            if lower != current_lower:
+                current_lower = lower
+                current_filtered = self.filter_name(lower)
+                self.name2substances[lower] = set()
+            
+            self.name2substances[lower].add((name_id, substance_id))
+            self.filtered_name2substances[current_filtered].add((name_id, substance_id))
+            
+            if not substance_id in self.substance_idents:
+                self.substance_idents[substance_id] = self.chembl_index.get_chembl_ident(drugbase_id=drugbase_id, molregno=molregno, chembl_id=chembl_id)
+            self.substance2names[self.substance_idents[substance_id]].add((name_id, substance_id))
+        
         self.substance2names = dict(self.substance2names)
+        self.filtered_name2substances = dict(self.filtered_name2substances)
 
+        name_session.close()
+        
         with open(f'{self.data_dir}/name2substances.pkl', 'wb') as f:
              pickle.dump(self.name2substances, f)
         with open(f'{self.data_dir}/substance2names.pkl', 'wb') as f:
              pickle.dump({k.__tuple__():vs for k,vs in self.substance2names.items()}, f)
-                
-        name_session.close()
-        
-        self.filtered_name2substances = self.gen_filtered_query_index()
-        
         with open(f'{self.data_dir}/filtered_name2substances.pkl', 'wb') as f:
              pickle.dump(self.filtered_name2substances, f)
 
@@ -399,16 +482,96 @@ class ChemblNameIndex():
             index = self.name2substances
         
         if q in index:
-            r = []
-            for name_id, substance_id in index[q]:
-                substance = self.get_substance(substance_id)
-                ci = self.chembl_index.get_chembl_ident(drugbase_id=substance.drugbase_id, molregno=substance.molregno, chembl_id=substance.chembl_id)
-                
-                name = self.get_name(name_id)
-                name = {'name': name.name, 'type': name.type, 'table': name.table}
-                
-                r.append({'substance': ci, 'name': name})
-            
+            return self.resolve_postings(index[q])
+    
+    def resolve_postings(self, postings):
+        names = self.get_names({name_id for name_id, substance_id in postings})
+        idents = self.get_substance_idents({substance_id for name_id, substance_id in postings})
+        
+        r = []
+        for name_id, substance_id in postings:
+            r.append({'substance': idents[substance_id], 'name': dict(names[name_id])})
+        
+        return r
+    
+    def query_name_tokens(self, q, limit=100, prefix=False):
+        # ranked token search on the FTS5 name index, any token may match (prefix matches tokens as prefixes)
+        # results are query_name results with the BM25 score of the matched name (lower is better), best first
+        if q is None:
+            return None
+        if self.name_store is None:
+            self.connect_to_namestore()
+        
+        tokens = re.findall(r'\w+', q.lower())
+        if not tokens:
+            return None
+        match = ' OR '.join(f'"{t}"*' if prefix else f'"{t}"' for t in tokens)
+        
+        ranked = self.name_session.execute(
+            sa.text("select rowid, lower, bm25(name_fts) from name_fts where name_fts match :match order by bm25(name_fts) limit :limit"), 
+            {'match': match, 'limit': limit}
+        ).fetchall()
+        if not ranked:
+            return None
+        scores = {name_id:score for name_id, lower, score in ranked}
+        
+        if not self.name2substances is None:
+            # postings of the matched names from the loaded query index
+            postings = [(name_id, substance_id) for lower in {lower for name_id, lower, score in ranked} if lower in self.name2substances for name_id, substance_id in self.name2substances[lower] if name_id in scores]
+        else:
+            Substance2Name = self.name_store.Substance2Name
+            postings = self.name_session.query(Substance2Name.name_id, Substance2Name.substance_id).filter(Substance2Name.name_id.in_(list(scores.keys()))).all()
+        
+        r = self.resolve_postings([(name_id, substance_id) for name_id, substance_id in postings])
+        for v, (name_id, substance_id) in zip(r, postings):
+            v['score'] = scores[name_id]
+        
+        return sorted(r, key=lambda v:v['score'])
+    
+    def gen_fuzzy_index(self, max_distance=2, prefix_length=7):
+        # deletion index over the filtered names
+        if self.filtered_name2substances is None:
+            self.load_query_index()
+        
+        self.fuzzy_index = FuzzyNameIndex.build(self.filtered_name2substances.keys(), max_distance=max_distance, prefix_length=prefix_length)
+        self.fuzzy_index.save(f'{self.data_dir}/fuzzy_name_index.pkl')
+        
+        return self.fuzzy_index
+    
+    def load_fuzzy_index(self):
+        # the index is built explicitly with gen_fuzzy_index, None if it hasn't been
+        try:
+            self.fuzzy_index = FuzzyNameIndex.load(f'{self.data_dir}/fuzzy_name_index.pkl')
+        except FileNotFoundError:
+            self.fuzzy_index = None
+        
+        return self.fuzzy_index
+    
+    def query_name_fuzzy(self, q, max_distance=None, exclude_exact=False):
+        # approximate match on the filtered names, results are query_name results with the edit distance of the matched name
+        # exclude_exact leaves out the name query_name(q, filter_name=True) finds, None if there is no fuzzy index
+        if self.filtered_name2substances is None:
+            self.load_query_index()
+        if self.fuzzy_index is None:
+            if self.load_fuzzy_index() is None:
+                return None
+        
+        if q is None:
+            return None
+        
+        filtered_q = self.filter_name(q)
+        if not bool(filtered_q):
+            filtered_q = q.lower()
+        
+        r = []
+        for name, distance in self.fuzzy_index.query(filtered_q, max_distance=max_distance):
+            if exclude_exact and (name == filtered_q):
+                continue
+            for v in self.resolve_postings(self.filtered_name2substances[name]):
+                v['distance'] = distance
+                r.append(v)
+        
+        if r:
             return r
         
     def query_substance_names(self, ci):
@@ -416,14 +579,10 @@ class ChemblNameIndex():
             self.load_query_index()
         
         if ci in self.substance2names:
-            r = []
-            for name_id, substance_id in self.substance2names[ci]:
-                name = self.get_name(name_id)
-                name = {'name': name.name, 'type': name.type, 'table': name.table}
-                
-                r.append(name)
+            postings = self.substance2names[ci]
+            names = self.get_names({name_id for name_id, substance_id in postings})
             
-            return r
+            return [dict(names[name_id]) for name_id, substance_id in postings]
         
     @staticmethod
     def filter_name(s):
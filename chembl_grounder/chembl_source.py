@@ -0,0 +1,244 @@
+import os
+import json
+import pickle
+import sqlite3
+from tqdm.auto import tqdm
+
+import cx_Oracle
+
+
+# name: (query, order by clause used to make resumable extractions deterministic)
+CHEMBL_QUERIES = {
+    'chembl_structures': (
+        "select MOLREGNO, STANDARD_INCHI from CHEMBL.COMPOUND_STRUCTURES",
+        "MOLREGNO"
+    ),
+    'drugbase_structure_ids': (
+        "select ID, MOLREGNO, MOLECULE_STRUCTURE_ID from DRUGBASE.MOLECULE_DICTIONARY",
+        "ID"
+    ),
+    'drugbase_structures': (
+        "select MOLECULE_STRUCTURE_ID, INCHI from DRUGBASE.MOLECULE_STRUCTURE",
+        "MOLECULE_STRUCTURE_ID"
+    ),
+    'drugbase_pref_names': (
+        "select MD.ID, MD.MOLREGNO, MD.PREF_NAME "
+        "from DRUGBASE.MOLECULE_DICTIONARY MD "
+        "where MD.DELETED = 0 ",
+        "MD.ID"
+    ),
+    'drugbase_synonyms': (
+        "select MD.ID, MD.MOLREGNO, MS.NAME, MST.NAME "
+        "from DRUGBASE.MOLECULE_SYNONYM MS "
+        "left join DRUGBASE.MOLECULE_SYNONYM_TYPE MST "
+        "on MS.MOLECULE_SYNONYM_TYPE_ID = MST.ID "
+        "left join DRUGBASE.MOLECULE_DICTIONARY MD "
+        "on MS.MOLECULE_DICTIONARY_ID = MD.ID "
+        "where MD.DELETED = 0 ",
+        "MS.ROWID"
+    ),
+    'drugbase_chemical_names': (
+        "select MD.ID, MD.MOLREGNO, MCN.NAME "
+        "from DRUGBASE.MOLECULE_CHEMICAL_NAME MCN "
+        "left join DRUGBASE.MOLECULE_DICTIONARY MD "
+        "on MCN.MOLECULE_DICTIONARY_ID = MD.ID "
+        "where MD.DELETED = 0 ",
+        "MCN.ROWID"
+    ),
+    'drugbase_dailymed_names': (
+        "select DC.MOLECULE_DICTIONARY_ID, DC.MOLREGNO, DC.DAILYMED_INGREDIENT "
+        "from DRUGBASE.DAILYMED_COMPOUNDS DC ",
+        "DC.ROWID"
+    ),
+    'chembl_pref_names': (
+        "select MD.CHEMBL_ID, MD.MOLREGNO, MD.PREF_NAME "
+        "from CHEMBL.MOLECULE_DICTIONARY MD ",
+        "MD.MOLREGNO"
+    ),
+    'chembl_synonyms': (
+        "select MD.CHEMBL_ID, MS.MOLREGNO, MS.SYNONYMS "
+        "from CHEMBL.MOLECULE_SYNONYMS MS "
+        "left join CHEMBL.MOLECULE_DICTIONARY MD "
+        "on MS.MOLREGNO = MD.MOLREGNO ",
+        "MS.ROWID"
+    ),
+    'chembl_compound_names': (
+        "select MD.CHEMBL_ID, CR.MOLREGNO, CR.COMPOUND_NAME "
+        "from CHEMBL.COMPOUND_RECORDS CR "
+        "left join CHEMBL.MOLECULE_DICTIONARY MD "
+        "on CR.MOLREGNO = MD.MOLREGNO ",
+        "CR.ROWID"
+    ),
+    'chembl_trade_names': (
+        "select MD.CHEMBL_ID, FO.MOLREGNO, PR.TRADE_NAME "
+        "from CHEMBL.FORMULATIONS FO left join CHEMBL.PRODUCTS PR "
+        "on FO.PRODUCT_ID = PR.PRODUCT_ID "
+        "left join CHEMBL.MOLECULE_DICTIONARY MD "
+        "on FO.MOLREGNO = MD.MOLREGNO ",
+        "FO.ROWID"
+    ),
+}
+
+def read_lob(v):
+    # LOBs are fetched inline as strings, but a cursor without the output type handler still returns LOB objects
+    if hasattr(v, 'read'):
+        return v.read()
+    return v
+
+def lob_output_type_handler(cursor, name, default_type, size, precision, scale):
+    if default_type == cx_Oracle.DB_TYPE_CLOB:
+        return cursor.var(cx_Oracle.DB_TYPE_LONG, arraysize=cursor.arraysize)
+    if default_type == cx_Oracle.DB_TYPE_BLOB:
+        return cursor.var(cx_Oracle.DB_TYPE_LONG_RAW, arraysize=cursor.arraysize)
+
+
+class OracleSource():
+    """
+    Bulk reads of the ChEMBL / Drugbase tables from Oracle, with large fetch batches and LOBs fetched inline
+    """
+
+    def __init__(self, connection, arraysize=10000, prefetchrows=10000):
+        self.connection = connection
+        self.arraysize = arraysize
+        self.prefetchrows = prefetchrows
+
+    def cursor(self):
+        cursor = self.connection.cursor()
+        cursor.arraysize = self.arraysize
+        cursor.prefetchrows = self.prefetchrows
+        cursor.outputtypehandler = lob_output_type_handler
+        return cursor
+
+    def rows(self, name, skip=0, ordered=False):
+        # ordered (and skip) give a stable row order so an interrupted extraction can be resumed
+        sql, order = CHEMBL_QUERIES[name]
+        if ordered or skip:
+            sql = f"{sql} order by {order}"
+        if skip:
+            sql = f"{sql} offset {int(skip)} rows"
+
+        cursor = self.cursor()
+        try:
+            cursor.execute(sql)
+            while True:
+                batch = cursor.fetchmany()
+                if not batch:
+                    break
+                for row in batch:
+                    yield tuple(read_lob(v) for v in row)
+        finally:
+            cursor.close()
+
+
+class SnapshotSource():
+    """
+    Local snapshot of another source, each query is written to chunked pickle files with a checkpoint so an interrupted extraction resumes where it stopped
+    """
+
+    def __init__(self, source, snapshot_dir, chunk_size=100000):
+        self.source = source
+        self.snapshot_dir = snapshot_dir
+        self.chunk_size = chunk_size
+
+    def load_checkpoint(self, name):
+        try:
+            with open(f"{self.snapshot_dir}/{name}/checkpoint.json", 'rt') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {'rows': 0, 'chunks': 0, 'complete': False}
+
+    def save_checkpoint(self, name, checkpoint):
+        with open(f"{self.snapshot_dir}/{name}/checkpoint.json.tmp", 'wt') as f:
+            json.dump(checkpoint, f)
+        os.replace(f"{self.snapshot_dir}/{name}/checkpoint.json.tmp", f"{self.snapshot_dir}/{name}/checkpoint.json")
+
+    def write_chunk(self, name, n, rows):
+        fn = f"{self.snapshot_dir}/{name}/chunk_{n:06d}.pkl"
+        with open(f"{fn}.tmp", 'wb') as f:
+            pickle.dump(rows, f)
+        os.replace(f"{fn}.tmp", fn)
+
+    def extract(self, name):
+        os.makedirs(f"{self.snapshot_dir}/{name}", exist_ok=True)
+
+        checkpoint = self.load_checkpoint(name)
+        if checkpoint['complete']:
+            return checkpoint
+
+        batch = []
+        for row in tqdm(self.source.rows(name, skip=checkpoint['rows'], ordered=True), initial=checkpoint['rows'], leave=True, position=0, desc=f'Extracting {name}'):
+            batch.append(row)
+            if len(batch) >= self.chunk_size:
+                self.write_chunk(name, checkpoint['chunks'], batch)
+                checkpoint['rows'] += len(batch)
+                checkpoint['chunks'] += 1
+                self.save_checkpoint(name, checkpoint)
+                batch = []
+
+        if batch:
+            self.write_chunk(name, checkpoint['chunks'], batch)
+            checkpoint['rows'] += len(batch)
+            checkpoint['chunks'] += 1
+        checkpoint['complete'] = True
+        self.save_checkpoint(name, checkpoint)
+
+        return checkpoint
+
+    def extract_all(self, names=None):
+        if names is None:
+            names = list(CHEMBL_QUERIES.keys())
+        return {name:self.extract(name) for name in names}
+
+    def rows(self, name, skip=0, ordered=False):
+        # snapshot rows are always in extraction order
+        checkpoint = self.extract(name)
+        for n in range(checkpoint['chunks']):
+            with open(f"{self.snapshot_dir}/{name}/chunk_{n:06d}.pkl", 'rb') as f:
+                rows = pickle.load(f)
+            if skip >= len(rows):
+                skip -= len(rows)
+                continue
+            yield from rows[skip:]
+            skip = 0
+
+
+class SqliteSource():
+    """
+    Reads the same queries from SQLite files, such as the public ChEMBL SQLite release or a fixture database.
+    The files are attached under the CHEMBL and DRUGBASE schema names so the Oracle SQL runs unchanged.
+    Queries on DRUGBASE tables return no rows if no Drugbase database is given (the public release has none).
+    """
+
+    def __init__(self, chembl_path, drugbase_path=None, chunk_size=10000):
+        self.chembl_path = chembl_path
+        self.drugbase_path = drugbase_path
+        self.chunk_size = chunk_size
+
+        self.connection = sqlite3.connect('file::memory:', uri=True, check_same_thread=False)
+        self.connection.execute("attach database ? as CHEMBL", (f"file:{chembl_path}?mode=ro",))
+        if not drugbase_path is None:
+            self.connection.execute("attach database ? as DRUGBASE", (f"file:{drugbase_path}?mode=ro",))
+
+    def rows(self, name, skip=0, ordered=False):
+        sql, order = CHEMBL_QUERIES[name]
+        if (self.drugbase_path is None) and ('DRUGBASE.' in sql):
+            return
+        if ordered or skip:
+            sql = f"{sql} order by {order}"
+        if skip:
+            sql = f"{sql} limit -1 offset {int(skip)}"
+
+        cursor = self.connection.cursor()
+        cursor.arraysize = self.chunk_size
+        try:
+            cursor.execute(sql)
+            while True:
+                batch = cursor.fetchmany()
+                if not batch:
+                    break
+                yield from batch
+        finally:
+            cursor.close()
+
+    def close(self):
+        self.connection.close()
@@ -1,19 +1,128 @@
+import os
 import pickle
 import json
 import sqlalchemy as sa
 import cx_Oracle
 from inchicompare import inchicompare as ic  # https://github.com/timrozday/inchicompare.git
-from collections import defaultdict
+from collections import defaultdict, Counter
+from concurrent.futures import ProcessPoolExecutor
 import rdkit
 from tqdm.auto import tqdm
 import itertools as it
+import copy
+import hashlib
+import random
 
 import chembl_ident
+from . import compact_index
+from . import chembl_source
+from .lru_cache import LRUCache
+from .fingerprint_index import FingerprintIndex
+
+def encode_fragments(fragment_conns):
+    return '\n'.join(f"{i}\t{c}" for i,c in fragment_conns.items())
+
+def decode_fragments(s):
+    return dict(l.split('\t') for l in s.split('\n'))
+
+def parse_inchi_layers(inchi):
+    # (formula, connectivity, ((layer, value), ...)), sublayers of the isotopic, fixed H and reconnected layers are prefixed with that layer (e.g. 'ih', 'fh')
+    parts = inchi.split('/')
+    formula = parts[1] if len(parts) > 1 else ''
+    conn = None
+    layers = []
+    section = ''
+    for p in parts[2:]:
+        if not p:
+            continue
+        l, v = p[0], p[1:]
+        if l in {'i', 'f', 'r'}:
+            section = l
+            layers.append((l, v))
+        elif (l == 'c') and (section == ''):
+            conn = v
+        else:
+            layers.append((f"{section}{l}", v))
+    return formula, conn, tuple(layers)
+
+def encode_layers(layers):
+    formula, conn, l = layers
+    return '\t'.join([formula, '' if conn is None else conn] + [f"{k}:{v}" for k,v in l])
+
+def decode_layers(s):
+    formula, conn, *l = s.split('\t')
+    return formula, (conn if conn else None), tuple(tuple(x.split(':', 1)) for x in l)
+
+optional_layers = {'h','f','p','q','i','t','b','m','s'}
+
+def project_layers(layers, filter_layers={'h','f','p','q','i','t','b','m','s'}):
+    # the parsed InChI without the optional layers that filter_layers leaves out
+    formula, conn, l = layers
+    return formula, conn, tuple((k,v) for k,v in l if (k[0] in filter_layers) or (not k[0] in optional_layers))
+
+def split_inchi_fragments(inchi):
+    # returns (fragment InChIs, complete), fragments is None if the InChI can't be parsed
+    mol = rdkit.Chem.MolFromInchi(inchi)
+    if mol is None:
+        return None, False
+    
+    fragments = []
+    try:
+        for m in rdkit.Chem.rdmolops.GetMolFrags(mol, asMols=True):  # split
+            fragments.append(rdkit.Chem.MolToInchi(m))
+    except:
+        return fragments, False
+    
+    return fragments, True
+
+def stripped_conn_layer(inchi, conn_split_inactive_inchis):
+    try:
+        inchi = ic.strip_inchi(inchi, exclude_inchis=conn_split_inactive_inchis)  # filter inchi
+    except:
+        pass
+
+    if inchi:
+        return ic.inchi_conn_layer(inchi)
+
+def index_compound(inchi, conn_split_inactive_inchis, split=None):
+    # everything the indexes need from one compound InChI, split is a precomputed (fragments, complete)
+    if split is None:
+        split = split_inchi_fragments(inchi)
+    fragments, complete = split
+    
+    fragment_conns = None
+    if not fragments is None:
+        fragment_conns = {i:ic.inchi_conn_layer(i) for i in fragments}
+    
+    return split, fragment_conns, stripped_conn_layer(inchi, conn_split_inactive_inchis)
+
+worker_conn_split_inactive_inchis = None
+
+def init_index_worker(conn_split_inactive_inchis):
+    global worker_conn_split_inactive_inchis
+    worker_conn_split_inactive_inchis = conn_split_inactive_inchis
+    rdkit.RDLogger.DisableLog('rdApp.*')
+
+def index_compound_chunk(chunk):
+    # module level so it can be sent to worker processes
+    return [index_compound(inchi, worker_conn_split_inactive_inchis, split=split) for inchi, split in chunk]
 
 class ChemblStructureIndex():
-    def __init__(self, data_dir='.', chembl_index=None):
+    posting_indexes = ['inchi_index', 'split_inchi_index', 'inchi_connectivity_index', 'inchi_split_connectivity_index']
+    
+    def __init__(self, data_dir='.', chembl_index=None, structure_cache=None, index_format='pickle', hashed_keys=False, consistency_cache_size=100000, normalisation_cache_size=100000, parsed_consistency=False):
         self.data_dir = data_dir
         self.chembl_db = None
+        self.index_format = index_format  # 'pickle' or 'compact' (integer IDs, CSR postings, memory-mapped)
+        self.hashed_keys = hashed_keys  # key the InChI and connectivity layer indexes by fixed-width digests, set from the saved indexes on load
+        self.consistency_cache = LRUCache(maxsize=consistency_cache_size)  # memo of compare_consistent results, 0 disables it
+        self.fingerprint_index = None  # optional similarity tier, see gen_fingerprint_index
+        self.normalisation_cache = LRUCache(maxsize=normalisation_cache_size)  # memo of stripped InChIs, conn layers and splits on the query path
+        self.reset_fanout_stats()
+        self.parsed_consistency = parsed_consistency  # settle identical fragment pairs, and indexed fragments identical on their stored layers, before ic.compare_consistent
+        self.fragment_layers = {}  # fragment InChI -> parse_inchi_layers, built at index time and loaded only with parsed_consistency
+        self.compound_conns = {}  # stripped connectivity layer of each compound, kept with hashed keys to drop collisions without re-stripping candidates
+        self.structure_cache = structure_cache  # optional StructureCache consulted before splitting InChIs
         if chembl_index is None:
             self.chembl_index = chembl_ident.ChemblIndexes(data_dir=self.data_dir)
         else:
@@ -31,6 +140,46 @@ class ChemblStructureIndex():
 #         print(chembl_db.dsn, "running version", chembl_db.version)
         
         return self.chembl_db
+    
+    def split_inchis(self, inchis, n_workers=1, write_cache=True):
+        # {inchi: (fragments, complete)}, consulting the structure cache first
+        # write_cache=False leaves the structure cache read-only, single queries don't pay for a write and commit per miss
+        inchis = set(inchis)
+        splits = {}
+        if not self.structure_cache is None:
+            for inchi, v in self.structure_cache.get_many('inchi_fragments', inchis).items():
+                splits[inchi] = (v['fragments'], v['complete'])
+        
+        todo = [inchi for inchi in inchis if not inchi in splits]
+        if (n_workers is None or n_workers > 1) and todo:
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                new_splits = dict(zip(todo, executor.map(split_inchi_fragments, todo, chunksize=1000)))
+        else:
+            new_splits = {inchi:split_inchi_fragments(inchi) for inchi in todo}
+        if (not self.structure_cache is None) and new_splits and write_cache:
+            self.structure_cache.set_many('inchi_fragments', [(inchi, {'fragments': f, 'complete': c}) for inchi,(f,c) in new_splits.items()])
+        splits.update(new_splits)
+        
+        return splits
+    
+    def split_inchi(self, inchi):
+        return self.normalisation_cache.get_or_compute(('split', inchi), lambda :self.split_inchis([inchi], write_cache=False)[inchi])
+    
+    def strip_inchi(self, inchi):
+        # memoised ic.strip_inchi with the inactive compounds excluded, failures are memoised too and raise ValueError
+        def strip():
+            try:
+                return True, ic.strip_inchi(inchi, exclude_inchis=self.conn_split_inactive_inchis)  # filter inchi
+            except Exception as e:
+                return False, str(e)
+        
+        ok, r = self.normalisation_cache.get_or_compute(('strip', inchi), strip)
+        if not ok:
+            raise ValueError(r)
+        return r
+    
+    def conn_layer(self, inchi):
+        return self.normalisation_cache.get_or_compute(('conn', inchi), lambda :ic.inchi_conn_layer(inchi))
 
     def load_inactive_compounds(self, data_dir=None):
         def trim_whitespace(s):
@@ -50,6 +199,25 @@ class ChemblStructureIndex():
         
         if data_dir is None:
             data_dir = self.data_dir
+        
+        # derived sets are cached, keyed by the content of the source files and the RDKit version
+        sources = {}
+        for fn in ['exclude_inchis.json', 'split_inactive_inchis.json', 'salts.smi', 'solvents.smi']:
+            with open(f"{data_dir}/{fn}", 'rb') as f:
+                sources[fn] = hashlib.sha1(f.read()).hexdigest()
+        sources['rdkit'] = rdkit.__version__
+        
+        try:
+            with open(f"{data_dir}/inactive_compounds.pkl", 'rb') as f:
+                cached = pickle.load(f)
+            if cached['sources'] == sources:
+                self.exclude_inchis = cached['exclude_inchis']
+                self.split_inactive_inchis = cached['split_inactive_inchis']
+                self.conn_split_inactive_inchis = cached['conn_split_inactive_inchis']
+                self.normalisation_cache.clear()
+                return
+        except Exception:
+            pass  # missing, partly written or older format, treated as a miss
             
         # load inactive data
         with open(f"{data_dir}/exclude_inchis.json", 'rt') as f:
@@ -87,93 +255,226 @@ class ChemblStructureIndex():
         self.split_inactive_inchis.update(solvents_inchi)
         
         self.conn_split_inactive_inchis = {ic.inchi_conn_layer(i) for i in self.split_inactive_inchis}
+        self.normalisation_cache.clear()  # stripped InChIs depend on the inactive compounds
+        
+        # write to a temporary file and swap it in, so workers starting at the same time never read a partial file
+        tmp_fn = f"{data_dir}/inactive_compounds.pkl.{os.getpid()}.tmp"
+        try:
+            with open(tmp_fn, 'wb') as f:
+                pickle.dump({
+                    'sources': sources, 
+                    'exclude_inchis': self.exclude_inchis, 
+                    'split_inactive_inchis': self.split_inactive_inchis, 
+                    'conn_split_inactive_inchis': self.conn_split_inactive_inchis
+                }, f)
+            os.replace(tmp_fn, f"{data_dir}/inactive_compounds.pkl")
+        except OSError:
+            pass  # read-only data directory, recompute next time
         
         
-    def fetch_data(self, data_dir=None):
+    def fetch_data(self, data_dir=None, chunk_size=10000, n_workers=1, source=None):
+        # source is an OracleSource (default, on the current connection), SqliteSource or SnapshotSource
         
         if data_dir is None:
             data_dir = self.data_dir
         
+        if source is None:
+            source = chembl_source.OracleSource(self.chembl_db)
+        
         self.load_inactive_compounds(data_dir=data_dir)
         
-        chembl_cursor = self.chembl_db.cursor()
+        self.compound_inchis = self.fetch_compound_inchis(source)
         
+        self.inchi_index = defaultdict(set)
+        for k,v in self.compound_inchis.items():
+            self.inchi_index[self.inchi_key(v)].add(k)
+        self.inchi_index = dict(self.inchi_index)
+        
+        # split InChIs describing multiple molecules and extract the connectivity layers
+        
+        self.split_inchi_index = {}
+        self.inchi_connectivity_index = {}
+        self.inchi_split_connectivity_index = {}
+        self.compound_fragments = {}  # all fragments of each compound with their connectivity layers, so queries don't re-split candidates
+        self.fragment_layers = {}
+        self.compound_conns = {}
+        self.index_compounds(self.compound_inchis.items(), n_workers=n_workers, chunk_size=chunk_size)
+    
+    def fetch_compound_inchis(self, source):
         # fetch structures
         
-        self.compound_inchis = {}
-        for molregno, inchi in tqdm(chembl_cursor.execute("select MOLREGNO, STANDARD_INCHI from CHEMBL.COMPOUND_STRUCTURES"), leave=True, position=0, desc='ChEMBL structures'):
+        compound_inchis = {}
+        for molregno, inchi in tqdm(source.rows('chembl_structures'), leave=True, position=0, desc='ChEMBL structures'):
             if inchi is None:
                 continue
             
             ci = self.chembl_index.get_chembl_ident(molregno=molregno)
-            self.compound_inchis[ci] = inchi
+            compound_inchis[ci] = inchi
         
         structure_id2drugbase_id = {}
-        for drugbase_id, mrn, structure_id in tqdm(chembl_cursor.execute('select ID, MOLREGNO, MOLECULE_STRUCTURE_ID from DRUGBASE.MOLECULE_DICTIONARY'), leave=True, position=0, desc='Drugbase structure IDs'):
+        for drugbase_id, mrn, structure_id in tqdm(source.rows('drugbase_structure_ids'), leave=True, position=0, desc='Drugbase structure IDs'):
             ci = self.chembl_index.get_chembl_ident(drugbase_id=drugbase_id)
             structure_id2drugbase_id[structure_id] = ci
         
-        for structure_id, inchi in tqdm(chembl_cursor.execute("select MOLECULE_STRUCTURE_ID, INCHI from DRUGBASE.MOLECULE_STRUCTURE"), leave=True, position=0, desc='Drugbase structures'):
+        for structure_id, inchi in tqdm(source.rows('drugbase_structures'), leave=True, position=0, desc='Drugbase structures'):
             if inchi is None:
                 continue
-            inchi = inchi.read()
+            inchi = chembl_source.read_lob(inchi)
             if inchi is None:
                 continue
             if structure_id in structure_id2drugbase_id:
                 ci = structure_id2drugbase_id[structure_id]
-                self.compound_inchis[ci] = inchi
+                compound_inchis[ci] = inchi
         
-        self.inchi_index = defaultdict(set)
-        for k,v in self.compound_inchis.items():
-            self.inchi_index[v].add(k)
+        return compound_inchis
+    
+    def update_indexes(self, chunk_size=10000, n_workers=1, source=None):
+        # apply only the added, deleted and modified structures of a new release to the loaded indexes
+        # the inactive compound sets are assumed unchanged, rebuild with fetch_data if they change
+        if source is None:
+            source = chembl_source.OracleSource(self.chembl_db)
         
-        # split InChIs describing multiple molecules
+        self.materialise_indexes()
         
-        self.split_inchi_index = defaultdict(set)
-        for ci, inchi in tqdm(self.compound_inchis.items(), leave=True, position=0, desc='Split InChIs'):    
-            mol = rdkit.Chem.MolFromInchi(inchi)
-            if mol is None:
-                continue
-            
-            try:
-                for m in rdkit.Chem.rdmolops.GetMolFrags(mol, asMols=True):  # split
-                    i = rdkit.Chem.MolToInchi(m)
-                    c = ic.inchi_conn_layer(i)
-                    if not c in self.conn_split_inactive_inchis:
-                        self.split_inchi_index[i].add(ci)  # add to index
-            except:
-                pass
-            
-        self.split_inchi_index = dict(self.split_inchi_index)   
+        new_compound_inchis = self.fetch_compound_inchis(source)
+        old_compound_inchis = self.compound_inchis
         
-        # extract connectivity layer of InChI and build index
+        deleted = [ci for ci in old_compound_inchis.keys() if not ci in new_compound_inchis]
+        modified = [ci for ci, inchi in new_compound_inchis.items() if (ci in old_compound_inchis) and (old_compound_inchis[ci] != inchi)]
+        added = [ci for ci in new_compound_inchis.keys() if not ci in old_compound_inchis]
         
-        self.inchi_connectivity_index = defaultdict(set)
-        for ci, inchi in tqdm(self.compound_inchis.items(), leave=True, position=0, desc='Connectivity layer InChI index'):
-            try:
-                inchi = ic.strip_inchi(inchi, exclude_inchis=self.conn_split_inactive_inchis)  # filter inchi
-            except:
-                pass
-
-            if inchi:
-                c = ic.inchi_conn_layer(inchi)
-                self.inchi_connectivity_index[c].add(ci)
-        self.inchi_connectivity_index = dict(self.inchi_connectivity_index)
+        for ci in tqdm(deleted + modified, leave=True, position=0, desc='Removing structures'):
+            self.remove_compound(ci, old_compound_inchis[ci])
         
-        self.inchi_split_connectivity_index = defaultdict(set)
-        for inchi, mols in tqdm(self.split_inchi_index.items(), leave=True, position=0, desc='Split connectivity layer InChI index'):
-            c = ic.inchi_conn_layer(inchi)
-        #     if not c in conn_split_inactive_inchis:
-            self.inchi_split_connectivity_index[c].update(mols)
+        for ci in added + modified:
+            self.inchi_index.setdefault(self.inchi_key(new_compound_inchis[ci]), set()).add(ci)
+        self.index_compounds([(ci, new_compound_inchis[ci]) for ci in added + modified], n_workers=n_workers, chunk_size=chunk_size)
         
-        self.inchi_split_connectivity_index = {k:v for k,v in self.inchi_split_connectivity_index.items() if not k in self.conn_split_inactive_inchis}  # remove innactive InChIs
+        self.compound_inchis = new_compound_inchis
+        self.normalisation_cache.clear()  # memoised compound conns and splits are of the old structures
         
-        chembl_cursor.close()
+        if not self.fingerprint_index is None:
+            # drop the fingerprints of deleted and modified compounds and add the new structures
+            self.fingerprint_index = self.fingerprint_index.update(
+                deleted + modified, 
+                self.fingerprint_items((ci, new_compound_inchis[ci]) for ci in added + modified), 
+                n_workers=n_workers, 
+                chunk_size=chunk_size
+            )
+        
+        return {'added': len(added), 'modified': len(modified), 'deleted': len(deleted)}
+    
+    def materialise_indexes(self):
+        # load memory-mapped (compact) indexes into plain dicts so they can be modified
+        if not isinstance(self.compound_inchis, dict):
+            self.compound_inchis = dict(self.compound_inchis.items())
+        if not isinstance(self.compound_fragments, dict):
+            self.compound_fragments = dict(self.compound_fragments.items())
+        if not isinstance(self.compound_conns, dict):
+            self.compound_conns = dict(self.compound_conns.items())
+        if not isinstance(self.fragment_layers, dict):
+            self.fragment_layers = dict(self.fragment_layers.items())
+        for name in self.posting_indexes:
+            index = getattr(self, name)
+            if not isinstance(index, dict):
+                setattr(self, name, {k:set(vs) for k,vs in index.items()})
+    
+    def remove_compound(self, ci, inchi):
+        def discard(index, k):
+            if k in index:
+                index[k].discard(ci)
+                if not index[k]:
+                    del index[k]
+        
+        discard(self.inchi_index, self.inchi_key(inchi))
+        
+        fragment_conns = self.compound_fragments.pop(ci, None)
+        if fragment_conns is None:
+            # not stored when the split was incomplete, the partial split is what was indexed
+            fragments, complete = self.split_inchi(inchi)
+            fragment_conns = {} if fragments is None else {i:ic.inchi_conn_layer(i) for i in fragments}
+        for i,c in fragment_conns.items():
+            discard(self.split_inchi_index, self.inchi_key(i))
+            discard(self.inchi_split_connectivity_index, self.conn_key(c))
+            if (not self.inchi_key(i) in self.split_inchi_index) and (not c in self.conn_split_inactive_inchis):
+                self.fragment_layers.pop(i, None)  # no indexed compound has this fragment any more, inactive fragments aren't in the index so are kept
+        
+        self.compound_conns.pop(ci, None)
+        stripped_conn = stripped_conn_layer(inchi, self.conn_split_inactive_inchis)
+        if stripped_conn:
+            discard(self.inchi_connectivity_index, self.conn_key(stripped_conn))
+        
+    def index_compounds(self, compound_items, n_workers=1, chunk_size=10000):
+        # split and strip compounds (in worker processes if n_workers is not 1) and merge them into the indexes in input order
+        compound_items = list(compound_items)
+        chunks = [compound_items[n:n+chunk_size] for n in range(0, len(compound_items), chunk_size)]
+        
+        def chunk_args(chunk):
+            cached = {}
+            if not self.structure_cache is None:
+                cached = self.structure_cache.get_many('inchi_fragments', [inchi for ci, inchi in chunk])
+            return [(inchi, (cached[inchi]['fragments'], cached[inchi]['complete']) if inchi in cached else None) for ci, inchi in chunk]
+        
+        def merge(chunk, args, results):
+            new_splits = []
+            for (ci, inchi), (_, cached_split), (split, fragment_conns, stripped_conn) in zip(chunk, args, results):
+                if cached_split is None:
+                    new_splits.append((inchi, {'fragments': split[0], 'complete': split[1]}))
+                self.add_compound(ci, split[1], fragment_conns, stripped_conn)
+            if (not self.structure_cache is None) and new_splits:
+                self.structure_cache.set_many('inchi_fragments', new_splits)
+        
+        if n_workers is None or n_workers > 1:
+            with ProcessPoolExecutor(max_workers=n_workers, initializer=init_index_worker, initargs=(self.conn_split_inactive_inchis,)) as executor:
+                chunk_args_list = [chunk_args(chunk) for chunk in chunks]
+                for chunk, args, results in tqdm(zip(chunks, chunk_args_list, executor.map(index_compound_chunk, chunk_args_list)), total=len(chunks), leave=True, position=0, desc='Split InChIs'):
+                    merge(chunk, args, results)
+        else:
+            for chunk in tqdm(chunks, leave=True, position=0, desc='Split InChIs'):
+                args = chunk_args(chunk)
+                results = [index_compound(inchi, self.conn_split_inactive_inchis, split=split) for inchi, split in args]
+                merge(chunk, args, results)
+    
+    def add_compound(self, ci, complete, fragment_conns, stripped_conn):
+        if not fragment_conns is None:
+            for i,c in fragment_conns.items():
+                if not c in self.conn_split_inactive_inchis:  # remove innactive InChIs
+                    self.split_inchi_index.setdefault(self.inchi_key(i), set()).add(ci)
+                    self.inchi_split_connectivity_index.setdefault(self.conn_key(c), set()).add(ci)
+            if complete:
+                self.compound_fragments[ci] = fragment_conns
+            if self.parsed_consistency:
+                for i in fragment_conns.keys():
+                    if not i in self.fragment_layers:
+                        self.fragment_layers[i] = parse_inchi_layers(i)
+        
+        if stripped_conn:
+            self.inchi_connectivity_index.setdefault(self.conn_key(stripped_conn), set()).add(ci)
+            if self.hashed_keys:
+                self.compound_conns[ci] = stripped_conn
         
     def save_indexes(self, data_dir=None):
         
         if data_dir is None:
             data_dir = self.data_dir
+        
+        with open(f"{data_dir}/structure_index_meta.json", 'wt') as f:
+            json.dump({'hashed_keys': self.hashed_keys}, f)
+        if self.parsed_consistency:
+            if self.index_format == 'compact':
+                compact_index.CompactStringMap.write(f"{data_dir}/compact_structure_index", 'fragment_layers', self.fragment_layers, encode=encode_layers)
+            else:
+                with open(f"{data_dir}/fragment_layers.pkl", 'wb') as f:
+                    pickle.dump(self.fragment_layers, f)
+        
+        if self.index_format == 'compact':
+            compact_index.save_compact_indexes(
+                f"{data_dir}/compact_structure_index", 
+                self.compound_inchis, 
+                {name:getattr(self, name) for name in self.posting_indexes}, 
+                values={'compound_fragments': (self.compound_fragments, encode_fragments), 'compound_conns': (self.compound_conns, lambda x:x)}
+            )
+            return
             
         with open(f"{data_dir}/compound_inchis.pkl", 'wb') as f:
             pickle.dump({k.__tuple__():vs for k,vs in self.compound_inchis.items()}, f)
@@ -185,6 +486,10 @@ class ChemblStructureIndex():
             pickle.dump({k:{v.__tuple__() for v in vs} for k,vs in self.inchi_connectivity_index.items()}, f)
         with open(f"{data_dir}/inchi_split_connectivity_index.pkl", 'wb') as f:
             pickle.dump({k:{v.__tuple__() for v in vs} for k,vs in self.inchi_split_connectivity_index.items()}, f)
+        with open(f"{data_dir}/compound_fragments.pkl", 'wb') as f:
+            pickle.dump({k.__tuple__():vs for k,vs in self.compound_fragments.items()}, f)
+        with open(f"{data_dir}/compound_conns.pkl", 'wb') as f:
+            pickle.dump({k.__tuple__():vs for k,vs in self.compound_conns.items()}, f)
     
     def load_indexes(self, data_dir=None):
         
@@ -193,6 +498,42 @@ class ChemblStructureIndex():
         
         self.load_inactive_compounds(data_dir=data_dir)
         
+        if os.path.exists(f"{data_dir}/fingerprint_index"):
+            self.load_fingerprint_index(data_dir=data_dir)
+        
+        try:
+            with open(f"{data_dir}/structure_index_meta.json", 'rt') as f:
+                self.hashed_keys = json.load(f)['hashed_keys']
+        except FileNotFoundError:
+            # no saved indexes keeps the constructor value, indexes saved before the meta file were unhashed
+            if os.path.exists(f"{data_dir}/inchi_index.pkl") or os.path.exists(f"{data_dir}/compact_structure_index"):
+                self.hashed_keys = False
+        
+        self.fragment_layers = {}
+        try:
+            if self.parsed_consistency and (self.index_format == 'compact'):
+                self.fragment_layers = compact_index.CompactStringMap(f"{data_dir}/compact_structure_index", 'fragment_layers', decode=decode_layers)
+            elif self.parsed_consistency:
+                with open(f"{data_dir}/fragment_layers.pkl", 'rb') as f:
+                    self.fragment_layers = pickle.load(f)
+        except FileNotFoundError:
+            pass  # indexes built without layers, fragments get parsed at query time
+        
+        if self.index_format == 'compact':
+            value_decoders = {'compound_fragments': decode_fragments}
+            if os.path.exists(f"{data_dir}/compact_structure_index/compound_conns.offsets.npy"):
+                value_decoders['compound_conns'] = lambda x:x
+            self.compound_inchis, indexes, values = compact_index.load_compact_indexes(
+                f"{data_dir}/compact_structure_index", 
+                self.posting_indexes, 
+                values=value_decoders
+            )
+            for name, index in indexes.items():
+                setattr(self, name, index)
+            self.compound_fragments = values['compound_fragments']
+            self.compound_conns = values['compound_conns'] if 'compound_conns' in values else {}
+            return
+        
         with open(f"{data_dir}/compound_inchis.pkl", 'rb') as f:
             self.compound_inchis = {chembl_ident.ChemblIdent(*k):vs for k,vs in pickle.load(f).items()}
         with open(f"{data_dir}/inchi_index.pkl", 'rb') as f:
@@ -203,8 +544,62 @@ class ChemblStructureIndex():
             self.inchi_connectivity_index = {k:{chembl_ident.ChemblIdent(*v) for v in vs} for k,vs in pickle.load(f).items()}
         with open(f"{data_dir}/inchi_split_connectivity_index.pkl", 'rb') as f:
             self.inchi_split_connectivity_index = {k:{chembl_ident.ChemblIdent(*v) for v in vs} for k,vs in pickle.load(f).items()}
+        try:
+            with open(f"{data_dir}/compound_fragments.pkl", 'rb') as f:
+                self.compound_fragments = {chembl_ident.ChemblIdent(*k):vs for k,vs in pickle.load(f).items()}
+        except FileNotFoundError:
+            # indexes built before fragments were stored, candidates get split at query time
+            self.compound_fragments = {}
+        try:
+            with open(f"{data_dir}/compound_conns.pkl", 'rb') as f:
+                self.compound_conns = {chembl_ident.ChemblIdent(*k):vs for k,vs in pickle.load(f).items()}
+        except FileNotFoundError:
+            self.compound_conns = {}
     
 
+    def fingerprint_items(self, compound_items):
+        # fingerprints are of the stripped compound InChIs
+        r = []
+        for ci, inchi in compound_items:
+            try:
+                inchi = ic.strip_inchi(inchi, exclude_inchis=self.conn_split_inactive_inchis)  # filter inchi
+            except:
+                pass
+            if inchi:
+                r.append((ci, inchi))
+        return r
+    
+    def gen_fingerprint_index(self, radius=2, nbits=1024, n_workers=1, chunk_size=10000):
+        compound_items = self.fingerprint_items(self.compound_inchis.items())
+        self.fingerprint_index = FingerprintIndex.build(compound_items, radius=radius, nbits=nbits, n_workers=n_workers, chunk_size=chunk_size)
+        return self.fingerprint_index
+    
+    def save_fingerprint_index(self, data_dir=None):
+        if data_dir is None:
+            data_dir = self.data_dir
+        self.fingerprint_index.save(f"{data_dir}/fingerprint_index")
+    
+    def load_fingerprint_index(self, data_dir=None):
+        if data_dir is None:
+            data_dir = self.data_dir
+        self.fingerprint_index = FingerprintIndex.load(f"{data_dir}/fingerprint_index")
+        return self.fingerprint_index
+    
+    def query_similar(self, inchi, k=10, threshold=0.0, strip=True):
+        # ranked [(ChemblIdent, tanimoto)] suggestions, not exact matches
+        if self.fingerprint_index is None:
+            return None
+        
+        if strip:
+            try:
+                stripped_inchi = self.strip_inchi(inchi)  # filter inchi
+                if stripped_inchi:
+                    inchi = stripped_inchi
+            except:
+                pass
+        
+        return self.fingerprint_index.query(inchi, k=k, threshold=threshold)
+    
     def get_structure(self, obj=None, drugbase_id=None, molregno=None, chembl_id=None):
         if obj is None:
             obj = self.chembl_index.get_chembl_ident(drugbase_id=drugbase_id, molregno=molregno, chembl_id=chembl_id)
@@ -212,44 +607,93 @@ class ChemblStructureIndex():
             if obj in self.compound_inchis:
                 return self.compound_inchis[obj]
     
+    def get_fragments(self, obj):
+        # precomputed {fragment InChI: connectivity layer} of an indexed compound
+        if obj in self.compound_fragments:
+            return self.compound_fragments[obj]
+    
+    def indexed_fragments(self, obj):
+        # {fragment InChI: connectivity layer} the compound was indexed under, the (possibly partial) split is computed and memoised when it wasn't stored
+        fragments = self.get_fragments(obj)
+        if fragments is None:
+            def split():
+                fragments, complete = self.split_inchi(self.compound_inchis[obj])
+                return {} if fragments is None else {i:ic.inchi_conn_layer(i) for i in fragments}
+            fragments = self.normalisation_cache.get_or_compute(('compound_fragments', obj), split)
+        return fragments
+    
+    def get_conn(self, obj):
+        # stripped connectivity layer of an indexed compound, stored at build time or computed once and memoised
+        if obj in self.compound_conns:
+            return self.compound_conns[obj]
+        return self.normalisation_cache.get_or_compute(('compound_conn', obj), lambda :stripped_conn_layer(self.compound_inchis[obj], self.conn_split_inactive_inchis))
+    
+    def inchi_key(self, inchi):
+        # key of the full InChI indexes, a 128-bit digest when keys are hashed
+        if self.hashed_keys:
+            return hashlib.blake2b(inchi.encode('utf-8'), digest_size=16).digest()
+        return inchi
+    
+    def conn_key(self, inchi_conn):
+        # key of the connectivity layer indexes, a 64-bit digest when keys are hashed
+        if self.hashed_keys:
+            return hashlib.blake2b(inchi_conn.encode('utf-8'), digest_size=8).digest()
+        return inchi_conn
+    
     def query_inchi_conn(self, inchi, strip=True):
         if strip:
             try:
-                inchi = ic.strip_inchi(inchi, exclude_inchis=self.conn_split_inactive_inchis)  # filter inchi
+                inchi = self.strip_inchi(inchi)  # filter inchi
             except:
                 pass
         
-        inchi_conn = ic.inchi_conn_layer(inchi)
+        inchi_conn = self.conn_layer(inchi)
+        k = self.conn_key(inchi_conn)
         
         r = set()
-        if inchi_conn in self.inchi_connectivity_index:
-            r.update(self.inchi_connectivity_index[inchi_conn])
-        if inchi_conn in self.inchi_split_connectivity_index:
-            r.update(self.inchi_split_connectivity_index[inchi_conn])
+        if k in self.inchi_connectivity_index:
+            vs = self.inchi_connectivity_index[k]
+            if self.hashed_keys:  # drop hash collisions
+                vs = {v for v in vs if self.get_conn(v) == inchi_conn}
+            r.update(vs)
+        if k in self.inchi_split_connectivity_index:
+            vs = self.inchi_split_connectivity_index[k]
+            if self.hashed_keys:
+                vs = {v for v in vs if inchi_conn in self.indexed_fragments(v).values()}
+            r.update(vs)
         return r
             
     def query_inchi(self, inchi, strip=True):
         if strip:
             try:
-                inchi = ic.strip_inchi(inchi, exclude_inchis=self.conn_split_inactive_inchis)  # filter inchi
+                inchi = self.strip_inchi(inchi)  # filter inchi
             except:
                 pass
         
+        k = self.inchi_key(inchi)
+        
         r = set()
-        if inchi in self.inchi_index:
-            r.update(self.inchi_index[inchi])
-        if inchi in self.split_inchi_index:
-            r.update(self.split_inchi_index[inchi])
+        if k in self.inchi_index:
+            vs = self.inchi_index[k]
+            if self.hashed_keys:  # drop hash collisions
+                vs = {v for v in vs if self.compound_inchis[v] == inchi}
+            r.update(vs)
+        if k in self.split_inchi_index:
+            vs = self.split_inchi_index[k]
+            if self.hashed_keys:
+                vs = {v for v in vs if inchi in self.indexed_fragments(v)}
+            r.update(vs)
         return r
     
     def is_active(self, inchi):
-        stripped_inchi = ic.strip_inchi(inchi, exclude_inchis=self.conn_split_inactive_inchis)  # filter inchi
+        stripped_inchi = self.strip_inchi(inchi)  # filter inchi
         return bool(stripped_inchi)
     
-    def query(self, inchi, connectivity=True, strip=True, consistency=True, split=True, inactive=False, filter_layers={'h','f','p','q','i','t','b','m','s'}):
+    def query(self, inchi, connectivity=True, strip=True, consistency=True, split=True, inactive=False, filter_layers={'h','f','p','q','i','t','b','m','s'}, max_candidates=None, prefilter=False):
+        # max_candidates caps the candidates checked per lookup, prefilter drops candidates that can't match the looked up InChI (each fragment when split) completely before the consistency checks
         if strip:
             try:
-                stripped_inchi = ic.strip_inchi(inchi, exclude_inchis=self.conn_split_inactive_inchis)  # filter inchi
+                stripped_inchi = self.strip_inchi(inchi)  # filter inchi
                 assert bool(stripped_inchi)
                 inchi = stripped_inchi
             except:
@@ -259,13 +703,12 @@ class ChemblStructureIndex():
                     pass
         
         if split:
-            mol = rdkit.Chem.MolFromInchi(inchi)
-            if not mol is None:
+            fragments, complete = self.split_inchi(inchi)
+            if complete:
                 try:
                     results = None
-                    for m in rdkit.Chem.rdmolops.GetMolFrags(mol, asMols=True):  # split
-                        i = rdkit.Chem.MolToInchi(m)
-                        r = self.query(i, connectivity=connectivity, strip=False, consistency=consistency, split=False)
+                    for i in fragments:
+                        r = self.query(i, connectivity=connectivity, strip=False, consistency=consistency, split=False, max_candidates=max_candidates, prefilter=prefilter)
                         if results:
                             results.update(r)
                         else:
@@ -274,60 +717,219 @@ class ChemblStructureIndex():
                 except:
                     pass
         
+        return self.query_candidates(inchi, connectivity=connectivity, strip=strip, consistency=consistency, filter_layers=filter_layers, max_candidates=max_candidates, prefilter=prefilter)
+    
+    def reset_fanout_stats(self):
+        self.fanout_stats = {
+            'queries': 0,
+            'candidates': 0,
+            'capped': 0,  # lookups where max_candidates fired
+            'capped_conns': Counter(),  # conn layer -> times capped
+            'prefiltered': 0,  # candidates dropped by the prefilter
+        }
+    
+    def active_conns(self, fragments):
+        return frozenset(c for c in (self.conn_layer(i) for i in fragments) if not c in self.conn_split_inactive_inchis)
+    
+    def candidate_conns(self, obj):
+        # set of active fragment conn layers of an indexed compound, None if it can't be split
+        fragments = self.get_fragments(obj)
+        if fragments is None:
+            structure = self.get_structure(obj)
+            if structure is None:
+                return None
+            fragments, complete = self.split_inchi(structure)
+            if not complete:
+                return None
+            fragments = {i:self.conn_layer(i) for i in fragments}
+        return frozenset(c for c in fragments.values() if not c in self.conn_split_inactive_inchis)
+    
+    def limit_candidates(self, inchi, r, inchi_fragments=None, max_candidates=None, prefilter=False):
+        self.fanout_stats['queries'] += 1
+        self.fanout_stats['candidates'] += len(r)
+        
+        if prefilter:
+            # cheap check before the consistency checks: a complete match to the looked up InChI has the same set of active fragment conn layers (salts and solvents are ignored)
+            if inchi_fragments is None:
+                inchi_fragments, complete = self.split_inchi(inchi)
+                if not complete:
+                    inchi_fragments = [inchi]
+            query_conns = self.active_conns(inchi_fragments)
+            
+            filtered = set()
+            for i in r:
+                i_conns = self.candidate_conns(i)
+                if (i_conns is None) or (i_conns == query_conns):
+                    filtered.add(i)
+            self.fanout_stats['prefiltered'] += len(r) - len(filtered)
+            r = filtered
+        
+        if (not max_candidates is None) and (len(r) > max_candidates):
+            # deterministic cap, the simplest compounds (fewest fragments, shortest InChI) are kept
+            def sort_key(i):
+                fragments = self.get_fragments(i)
+                structure = self.get_structure(i) or ''
+                return (len(fragments) if not fragments is None else structure.count('.')+1, len(structure), compact_index.compound_key(i))
+            
+            self.fanout_stats['capped'] += 1
+            self.fanout_stats['capped_conns'][self.conn_layer(inchi)] += 1
+            r = set(sorted(r, key=sort_key)[:max_candidates])
+        
+        return r
+    
+    def query_candidates(self, inchi, connectivity=True, strip=True, consistency=True, filter_layers={'h','f','p','q','i','t','b','m','s'}, inchi_fragments=None, max_candidates=None, prefilter=False):
+        # look up an (already stripped) InChI without splitting it, inchi_fragments is its precomputed split
         if connectivity:
             r = self.query_inchi_conn(inchi, strip=False)
         else:
             r = self.query_inchi(inchi, strip=False)
-            
+        
+        r = self.limit_candidates(inchi, r, inchi_fragments=inchi_fragments, max_candidates=max_candidates, prefilter=prefilter)
             
         if consistency:
             consistencies = {}
             for i in r:
-                r_inchi = self.get_structure(i)  # get inchi
+                r_inchi = self.get_fragments(i)  # precomputed fragments
+                if r_inchi is None:
+                    r_inchi = self.get_structure(i)  # get inchi
 #                 consistencies[i] = ic.compare_consistent(inchi, r_inchi, filter_layers=filter_layers)  # compare with query to get consistency
-                consistencies[i] = self.inchi_overlap(inchi, r_inchi, strip=strip, consistency=consistency, filter_layers=filter_layers)
+                consistencies[i] = self.inchi_overlap(inchi if inchi_fragments is None else inchi_fragments, r_inchi, strip=strip, consistency=consistency, filter_layers=filter_layers)
             return consistencies
         else:
             return r
     
+    def query_many(self, inchis, connectivity=True, strip=True, consistency=True, split=True, inactive=False, filter_layers={'h','f','p','q','i','t','b','m','s'}, n_workers=1, max_candidates=None, prefilter=False):
+        # same results as [self.query(inchi, ...) for inchi in inchis], but fragments shared across the batch are split and looked up once
+        stripped_inchis = []
+        for inchi in inchis:
+            if strip:
+                try:
+                    stripped_inchi = self.strip_inchi(inchi)  # filter inchi
+                    assert bool(stripped_inchi)
+                    inchi = stripped_inchi
+                except:
+                    if inactive == False:
+                        inchi = None
+            stripped_inchis.append(inchi)
+        
+        splits = {}
+        fragment_results = {}
+        if split:
+            splits = self.split_inchis({inchi for inchi in stripped_inchis if not inchi is None}, n_workers=n_workers)
+            fragments = {i for fragments, complete in splits.values() if complete for i in fragments}
+            fragment_splits = self.split_inchis(fragments, n_workers=n_workers)
+            
+            for i in tqdm(fragments, leave=True, position=0, desc='Querying fragments', disable=len(fragments) < 1000):
+                fragment_split, complete = fragment_splits[i]
+                if not complete:
+                    fragment_results[i] = None  # query() would fail on this fragment and fall back to the whole InChI
+                    continue
+                try:
+                    # as in query(), fragments are looked up unstripped with the default filter_layers
+                    fragment_results[i] = (self.query_candidates(i, connectivity=connectivity, strip=False, consistency=consistency, inchi_fragments=fragment_split, max_candidates=max_candidates, prefilter=prefilter), )
+                except:
+                    fragment_results[i] = None
+        
+        results = []
+        for inchi in stripped_inchis:
+            if inchi is None:
+                results.append(None)
+                continue
+            
+            if split and splits[inchi][1] and all(not fragment_results[i] is None for i in splits[inchi][0]):
+                r = None
+                for i in splits[inchi][0]:
+                    fr = fragment_results[i][0]
+                    if r:
+                        r.update(fr)
+                    else:
+                        r = copy.copy(fr)  # fragment results are shared between inputs
+                results.append(r)
+            else:
+                results.append(self.query_candidates(inchi, connectivity=connectivity, strip=strip, consistency=consistency, filter_layers=filter_layers, max_candidates=max_candidates, prefilter=prefilter))
+        
+        return results
+    
+    def compare_parsed(self, inchi1, inchi2, filter_layers={'h','f','p','q','i','t','b','m','s'}):
+        # identical pairs, and indexed fragments with stored layers that are identical apart from the layers filter_layers leaves out, are consistent
+        # anything else goes to the memoised ic.compare_consistent, so results are the same as without parsed_consistency and nothing is parsed at query time
+        # a full layer comparison on the parsed tuples isn't implemented, it can't be checked against inchicompare's rules here
+        if inchi1 == inchi2:
+            return True, None
+        if (inchi1 in self.fragment_layers) and (inchi2 in self.fragment_layers):
+            if project_layers(self.fragment_layers[inchi1], filter_layers=filter_layers) == project_layers(self.fragment_layers[inchi2], filter_layers=filter_layers):
+                return True, None
+        return self.compare_consistent(inchi1, inchi2, filter_layers=filter_layers)
+    
+    def check_parsed_consistency(self, sample_size=10000, filter_layers={'h','f','p','q','i','t','b','m','s'}, seed=0):
+        # parity check of compare_parsed against ic.compare_consistent on fragment pairs that share a connectivity layer
+        conn_fragments = defaultdict(set)
+        for fragment_conns in self.compound_fragments.values():
+            for i,c in fragment_conns.items():
+                conn_fragments[c].add(i)
+        
+        groups = [sorted(fragments) for fragments in conn_fragments.values() if len(fragments) > 1]
+        n_pairs = sum(len(g)*(len(g)-1) for g in groups)
+        if n_pairs <= sample_size:
+            pairs = [(i1, i2) for g in groups for i1, i2 in it.permutations(g, 2)]
+        else:
+            # sampled without building every pair, a group is picked in proportion to its number of pairs and then two of its members
+            rng = random.Random(seed)
+            cum_weights = list(it.accumulate(len(g)*(len(g)-1) for g in groups))
+            pairs = set()
+            while len(pairs) < sample_size:
+                g = rng.choices(groups, cum_weights=cum_weights)[0]
+                pairs.add(tuple(rng.sample(g, 2)))
+            pairs = sorted(pairs)
+        
+        mismatches = []
+        for i1, i2 in tqdm(pairs, leave=True, position=0, desc='Checking parsed consistency'):
+            c1, s1 = self.compare_parsed(i1, i2, filter_layers=filter_layers)
+            c2, s2 = ic.compare_consistent(i1, i2, filter_layers=filter_layers)
+            if c1 != c2:
+                mismatches.append((i1, i2))
+        
+        return {'pairs': len(pairs), 'mismatches': mismatches}
+    
+    def compare_consistent(self, inchi1, inchi2, filter_layers={'h','f','p','q','i','t','b','m','s'}):
+        return self.consistency_cache.get_or_compute(
+            (inchi1, inchi2, frozenset(filter_layers)), 
+            lambda :ic.compare_consistent(inchi1, inchi2, filter_layers=filter_layers)
+        )
+    
     def inchi_overlap(self, inchi1, inchi2, strip=True, consistency=True, filter_layers={'h','f','p','q','i','t','b','m','s'}):
+        def strip_fragments(fragment_conns, strip=True):
+            if strip:
+                return {i:c for i,c in fragment_conns.items() if not c in self.conn_split_inactive_inchis}
+            return dict(fragment_conns)
+        
         def split_strip(inchi, strip=True):
-            mol = rdkit.Chem.MolFromInchi(inchi)
-            split_inchis = set()
-            for m in rdkit.Chem.rdmolops.GetMolFrags(mol, asMols=True):  # split
-                i = rdkit.Chem.MolToInchi(m)
-
-                if strip:
-                    c = ic.inchi_conn_layer(i)
-                    if not c in self.conn_split_inactive_inchis:
-                        split_inchis.add(i)
-                else:
-                    split_inchis.add(i)
-
-            return split_inchis
-
-        if isinstance(inchi1, list):
-            inchi1 = set(inchi1)
-        if isinstance(inchi2, list):
-            inchi2 = set(inchi2)
-
-        if isinstance(inchi1, set):
-            split_inchis1 = set(inchi1)
-        else:
-            split_inchis1 = split_strip(inchi1, strip=strip)
-
-        if isinstance(inchi2, set):
-            split_inchis2 = set(inchi2)
-        else:
-            split_inchis2 = split_strip(inchi2, strip=strip)
+            fragments, complete = self.split_inchi(inchi)
+            if not complete:
+                raise ValueError(f"Failed to split InChI: {inchi}")
+            
+            return strip_fragments({i:self.conn_layer(i) for i in fragments}, strip=strip)
+        
+        def fragment_conns(inchi, strip=True):
+            # a dict is a precomputed {fragment: conn layer} table, lists and sets are already split
+            if isinstance(inchi, dict):
+                return strip_fragments(inchi, strip=strip)
+            if isinstance(inchi, (list, set, frozenset)):
+                return {i:self.conn_layer(i) for i in inchi}
+            return split_strip(inchi, strip=strip)
+        
+        fragment_conns1 = fragment_conns(inchi1, strip=strip)
+        fragment_conns2 = fragment_conns(inchi2, strip=strip)
+        split_inchis1 = set(fragment_conns1.keys())
+        split_inchis2 = set(fragment_conns2.keys())
 
         # get conn layer
         conn_split_inchis1 = defaultdict(set)
-        for i in split_inchis1:
-            conn_split_inchis1[ic.inchi_conn_layer(i)].add(i)
+        for i,c in fragment_conns1.items():
+            conn_split_inchis1[c].add(i)
         conn_split_inchis2 = defaultdict(set)
-        for i in split_inchis2:
-            conn_split_inchis2[ic.inchi_conn_layer(i)].add(i)
+        for i,c in fragment_conns2.items():
+            conn_split_inchis2[c].add(i)
 
         # compare conn layers to get candidate matches
         candidates = set()
@@ -338,7 +940,10 @@ class ChemblStructureIndex():
         matches = set()
         for i1,i2 in candidates:
             if consistency:
-                c,s = ic.compare_consistent(i1, i2, filter_layers=filter_layers)
+                if self.parsed_consistency:
+                    c,s = self.compare_parsed(i1, i2, filter_layers=filter_layers)
+                else:
+                    c,s = self.compare_consistent(i1, i2, filter_layers=filter_layers)
                 if c:
                     matches.add((i1,i2))
             else:
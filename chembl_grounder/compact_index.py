@@ -0,0 +1,231 @@
+import os
+import json
+from collections.abc import Mapping
+
+import numpy as np
+
+import chembl_ident
+
+
+def load_array(path, mmap=True):
+    try:
+        return np.load(path, mmap_mode='r' if mmap else None)
+    except ValueError:
+        # empty arrays can't be memory-mapped
+        return np.load(path)
+
+def encode_key(key):
+    if isinstance(key, bytes):
+        return key
+    return key.encode('utf-8')
+
+def compound_key(ci):
+    return encode_key(json.dumps(ci.__tuple__()))
+
+
+class StringTable():
+    """
+    Strings stored as one UTF-8 blob plus an offset array, both memory-mapped.
+    A table written with sorted keys can be searched with find().
+    """
+
+    def __init__(self, path, mmap=True):
+        self.path = path
+        self.blob = load_array(f"{path}.blob.npy", mmap=mmap)
+        self.offsets = load_array(f"{path}.offsets.npy", mmap=mmap)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def get_bytes(self, i):
+        return self.blob[self.offsets[i]:self.offsets[i+1]].tobytes()
+
+    def __getitem__(self, i):
+        return self.get_bytes(i).decode('utf-8')
+
+    def find(self, key):
+        # binary search, returns the position of key or None
+        key = encode_key(key)
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.get_bytes(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if (lo < len(self)) and (self.get_bytes(lo) == key):
+            return lo
+
+    @staticmethod
+    def write(path, strings):
+        strings = [encode_key(s) for s in strings]
+        offsets = np.zeros(len(strings)+1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(s) for s in strings], dtype=np.int64)
+        np.save(f"{path}.blob.npy", np.frombuffer(b''.join(strings), dtype=np.uint8))
+        np.save(f"{path}.offsets.npy", offsets)
+
+
+class CompactCompounds():
+    """
+    Compounds interned to integer IDs, the ID is the position of the compound in a sorted string table
+    """
+
+    def __init__(self, path, mmap=True):
+        self.table = StringTable(f"{path}/compounds", mmap=mmap)
+        self.idents = {}
+
+    def __len__(self):
+        return len(self.table)
+
+    def ident(self, i):
+        if not i in self.idents:
+            self.idents[i] = chembl_ident.ChemblIdent(*json.loads(self.table[i]))
+        return self.idents[i]
+
+    def find(self, ci):
+        return self.table.find(compound_key(ci))
+
+
+class CompactValues(Mapping):
+    """
+    Read-only dict of compound -> value, values are stored in a string table aligned with the compound IDs
+    """
+
+    def __init__(self, path, name, compounds, decode=lambda x:x, mmap=True):
+        self.compounds = compounds
+        self.values = StringTable(f"{path}/{name}", mmap=mmap)
+        self.decode = decode
+
+    def __getitem__(self, ci):
+        i = self.compounds.find(ci)
+        if i is None:
+            raise KeyError(ci)
+        v = self.values[i]
+        if not v:
+            raise KeyError(ci)
+        return self.decode(v)
+
+    def __iter__(self):
+        for i in range(len(self.compounds)):
+            if self.values.offsets[i+1] > self.values.offsets[i]:
+                yield self.compounds.ident(i)
+
+    def __len__(self):
+        return int(np.count_nonzero(np.diff(self.values.offsets)))
+
+    @staticmethod
+    def write(path, name, compounds, values, encode=lambda x:x):
+        StringTable.write(f"{path}/{name}", [encode(values[ci]) if ci in values else '' for ci in compounds])
+
+
+class CompactPostings(Mapping):
+    """
+    Read-only dict of key -> set of compounds, stored CSR style as a sorted key table, an offset array and an array of compound IDs
+    """
+
+    def __init__(self, path, name, compounds, mmap=True):
+        self.compounds = compounds
+        self.keys = StringTable(f"{path}/{name}.keys", mmap=mmap)
+        self.offsets = load_array(f"{path}/{name}.offsets.npy", mmap=mmap)
+        self.values = load_array(f"{path}/{name}.values.npy", mmap=mmap)
+        with open(f"{path}/{name}.json", 'rt') as f:
+            self.binary_keys = json.load(f)['binary_keys']
+
+    def get_ids(self, key):
+        i = self.keys.find(key)
+        if i is None:
+            return None
+        return self.values[self.offsets[i]:self.offsets[i+1]]
+
+    def __getitem__(self, key):
+        ids = self.get_ids(key)
+        if ids is None:
+            raise KeyError(key)
+        return {self.compounds.ident(int(i)) for i in ids}
+
+    def __contains__(self, key):
+        return not self.keys.find(key) is None
+
+    def __iter__(self):
+        for i in range(len(self.keys)):
+            if self.binary_keys:
+                yield self.keys.get_bytes(i)
+            else:
+                yield self.keys[i]
+
+    def __len__(self):
+        return len(self.keys)
+
+    @staticmethod
+    def write(path, name, index, compound_ids):
+        items = sorted(((encode_key(k), vs) for k,vs in index.items()), key=lambda x:x[0])
+        offsets = np.zeros(len(items)+1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(vs) for k,vs in items], dtype=np.int64)
+        values = np.fromiter((i for k,vs in items for i in sorted(compound_ids[v] for v in vs)), dtype=np.int32, count=int(offsets[-1]))
+
+        StringTable.write(f"{path}/{name}.keys", [k for k,vs in items])
+        np.save(f"{path}/{name}.offsets.npy", offsets)
+        np.save(f"{path}/{name}.values.npy", values)
+        with open(f"{path}/{name}.json", 'wt') as f:
+            json.dump({'binary_keys': any(isinstance(k, bytes) for k in index.keys())}, f)
+
+
+class CompactStringMap(Mapping):
+    """
+    Read-only dict of string -> value, a sorted key table with an aligned value table
+    """
+
+    def __init__(self, path, name, decode=lambda x:x, mmap=True):
+        self.keys = StringTable(f"{path}/{name}.keys", mmap=mmap)
+        self.values = StringTable(f"{path}/{name}.values", mmap=mmap)
+        self.decode = decode
+
+    def __getitem__(self, key):
+        i = self.keys.find(key)
+        if i is None:
+            raise KeyError(key)
+        return self.decode(self.values[i])
+
+    def __contains__(self, key):
+        return not self.keys.find(key) is None
+
+    def __iter__(self):
+        for i in range(len(self.keys)):
+            yield self.keys[i]
+
+    def __len__(self):
+        return len(self.keys)
+
+    @staticmethod
+    def write(path, name, d, encode=lambda x:x):
+        os.makedirs(path, exist_ok=True)
+        items = sorted(((encode_key(k), encode(v)) for k,v in d.items()), key=lambda x:x[0])
+        StringTable.write(f"{path}/{name}.keys", [k for k,v in items])
+        StringTable.write(f"{path}/{name}.values", [v for k,v in items])
+
+
+def save_compact_indexes(path, compound_inchis, indexes, values={}):
+    # indexes is {name: {key: set of compounds}}, values is {name: ({compound: value}, encode)}
+    os.makedirs(path, exist_ok=True)
+
+    compounds = set(compound_inchis.keys())
+    for index in indexes.values():
+        for vs in index.values():
+            compounds.update(vs)
+    compounds = sorted(compounds, key=compound_key)
+    compound_ids = {ci:i for i,ci in enumerate(compounds)}
+
+    StringTable.write(f"{path}/compounds", [compound_key(ci) for ci in compounds])
+    CompactValues.write(path, 'compound_inchis', compounds, compound_inchis)
+    for name, (d, encode) in values.items():
+        CompactValues.write(path, name, compounds, d, encode=encode)
+    for name, index in indexes.items():
+        CompactPostings.write(path, name, index, compound_ids)
+
+def load_compact_indexes(path, names, values={}, mmap=True):
+    # returns compound_inchis, {name: postings} and {name: values}, values is {name: decode}
+    compounds = CompactCompounds(path, mmap=mmap)
+    compound_inchis = CompactValues(path, 'compound_inchis', compounds, mmap=mmap)
+    indexes = {name:CompactPostings(path, name, compounds, mmap=mmap) for name in names}
+    values = {name:CompactValues(path, name, compounds, decode=decode, mmap=mmap) for name, decode in values.items()}
+    return compound_inchis, indexes, values
@@ -0,0 +1,133 @@
+import os
+import json
+from concurrent.futures import ProcessPoolExecutor
+from tqdm.auto import tqdm
+
+import numpy as np
+import rdkit
+from rdkit import Chem, DataStructs
+from rdkit.Chem import AllChem
+
+from . import compact_index
+
+popcount_table = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+def inchi_fingerprint(inchi, radius=2, nbits=1024):
+    # bit-packed Morgan fingerprint, None if the InChI can't be parsed
+    mol = Chem.MolFromInchi(inchi)
+    if mol is None:
+        return None
+    fp = AllChem.GetMorganFingerprintAsBitVect(mol, radius, nBits=nbits)
+    bits = np.zeros((nbits,), dtype=np.uint8)
+    DataStructs.ConvertToNumpyArray(fp, bits)
+    return np.packbits(bits)
+
+def fingerprint_chunk(args):
+    # module level so it can be sent to worker processes
+    inchis, radius, nbits = args
+    rdkit.RDLogger.DisableLog('rdApp.*')
+    return [inchi_fingerprint(inchi, radius=radius, nbits=nbits) for inchi in inchis]
+
+def popcount(a):
+    # row-wise bit count of a 2D uint8 array
+    if hasattr(np, 'bitwise_count') and (a.shape[1] % 8 == 0):
+        return np.bitwise_count(np.ascontiguousarray(a).view(np.uint64)).sum(axis=1, dtype=np.int32)
+    return popcount_table[a].sum(axis=1, dtype=np.int32)
+
+
+class FingerprintIndex():
+    """
+    Bit-packed fingerprint matrix over the indexed compounds with chunked, vectorised Tanimoto top-k search
+    """
+
+    def __init__(self, fingerprints, counts, compounds, radius=2, nbits=1024):
+        self.fingerprints = fingerprints  # (n, nbits/8) uint8
+        self.counts = counts  # (n,) bits set per row
+        self.compounds = compounds  # row -> ChemblIdent
+        self.radius = radius
+        self.nbits = nbits
+
+    @classmethod
+    def build(cls, compound_items, radius=2, nbits=1024, n_workers=1, chunk_size=10000):
+        compound_items = list(compound_items)
+        chunks = [([inchi for ci, inchi in compound_items[n:n+chunk_size]], radius, nbits) for n in range(0, len(compound_items), chunk_size)]
+
+        if n_workers is None or n_workers > 1:
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                fps = [fp for r in tqdm(executor.map(fingerprint_chunk, chunks), total=len(chunks), leave=True, position=0, desc='Fingerprints') for fp in r]
+        else:
+            fps = [fp for c in tqdm(chunks, leave=True, position=0, desc='Fingerprints') for fp in fingerprint_chunk(c)]
+
+        rows = [(ci, fp) for (ci, inchi), fp in zip(compound_items, fps) if not fp is None]
+        fingerprints = np.zeros((len(rows), nbits // 8), dtype=np.uint8)
+        for i, (ci, fp) in enumerate(rows):
+            fingerprints[i] = fp
+
+        return cls(fingerprints, popcount(fingerprints), [ci for ci, fp in rows], radius=radius, nbits=nbits)
+
+    def update(self, removed, compound_items, n_workers=1, chunk_size=10000):
+        # new index without the removed compounds and with fingerprints for compound_items appended
+        removed = set(removed)
+        keep = [i for i in range(len(self.compounds)) if not self.get_compound(i) in removed]
+        added = self.build(compound_items, radius=self.radius, nbits=self.nbits, n_workers=n_workers, chunk_size=chunk_size)
+
+        fingerprints = np.concatenate([np.asarray(self.fingerprints)[keep], added.fingerprints])
+        counts = np.concatenate([np.asarray(self.counts)[keep], added.counts])
+        compounds = [self.get_compound(i) for i in keep] + list(added.compounds)
+        return self.__class__(fingerprints, counts, compounds, radius=self.radius, nbits=self.nbits)
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        np.save(f"{path}/fingerprints.npy", self.fingerprints)
+        np.save(f"{path}/fingerprint_counts.npy", self.counts)
+        compact_index.StringTable.write(f"{path}/compounds", [compact_index.compound_key(ci) for ci in self.compounds])
+        with open(f"{path}/fingerprint_meta.json", 'wt') as f:
+            json.dump({'radius': self.radius, 'nbits': self.nbits}, f)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        with open(f"{path}/fingerprint_meta.json", 'rt') as f:
+            meta = json.load(f)
+        fingerprints = compact_index.load_array(f"{path}/fingerprints.npy", mmap=mmap)
+        counts = compact_index.load_array(f"{path}/fingerprint_counts.npy", mmap=mmap)
+        compounds = compact_index.CompactCompounds(path, mmap=mmap)
+        return cls(fingerprints, counts, compounds, radius=meta['radius'], nbits=meta['nbits'])
+
+    def get_compound(self, i):
+        if isinstance(self.compounds, compact_index.CompactCompounds):
+            return self.compounds.ident(i)
+        return self.compounds[i]
+
+    def query_fingerprint(self, fp, k=10, threshold=0.0, chunk_size=200000):
+        # returns [(row, tanimoto)] best first
+        q_count = int(popcount_table[fp].sum())
+        if q_count == 0:
+            return []
+
+        best_rows = []
+        best_scores = []
+        for n in range(0, len(self.fingerprints), chunk_size):
+            chunk = np.asarray(self.fingerprints[n:n+chunk_size])
+            inter = popcount(np.bitwise_and(chunk, fp))
+            union = q_count + np.asarray(self.counts[n:n+chunk_size]) - inter
+            scores = inter / np.maximum(union, 1)
+
+            keep = np.nonzero(scores >= threshold)[0] if threshold > 0 else np.arange(len(scores))
+            if len(keep) > k:
+                keep = keep[np.argpartition(-scores[keep], k-1)[:k]]
+            best_rows.append(keep + n)
+            best_scores.append(scores[keep])
+
+        if not best_rows:
+            return []
+        rows = np.concatenate(best_rows)
+        scores = np.concatenate(best_scores)
+        order = np.lexsort((rows, -scores))[:k]  # highest score first, ties by row
+
+        return [(int(rows[i]), float(scores[i])) for i in order]
+
+    def query(self, inchi, k=10, threshold=0.0):
+        fp = inchi_fingerprint(inchi, radius=self.radius, nbits=self.nbits)
+        if fp is None:
+            return []
+        return [(self.get_compound(i), score) for i, score in self.query_fingerprint(fp, k=k, threshold=threshold)]
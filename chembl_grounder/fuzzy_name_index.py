@@ -0,0 +1,134 @@
+import os
+import re
+import pickle
+import itertools as it
+from tqdm.auto import tqdm
+
+
+def normalise_name(s):
+    # hyphens are removed and word order and commas don't count towards the distance
+    return ' '.join(sorted(t for t in re.split(r'[\s,]+', s.lower().replace('-', '')) if t))
+
+def name_deletes(s, max_distance=2, prefix_length=7):
+    # all variants of the name prefix with up to max_distance characters deleted
+    s = s[:prefix_length]
+    deletes = {s}
+    for d in range(1, min(max_distance, len(s))+1):
+        for positions in it.combinations(range(len(s)), d):
+            deletes.add(''.join(c for i,c in enumerate(s) if not i in positions))
+    return deletes
+
+def edit_distance(s1, s2, max_distance=None):
+    # optimal string alignment distance (Damerau-Levenshtein without repeated edits), None once it exceeds max_distance
+    if (not max_distance is None) and (abs(len(s1) - len(s2)) > max_distance):
+        return None
+
+    prev2 = None
+    prev = list(range(len(s2)+1))
+    for i in range(1, len(s1)+1):
+        row = [i] + [0]*len(s2)
+        for j in range(1, len(s2)+1):
+            cost = 0 if s1[i-1] == s2[j-1] else 1
+            row[j] = min(prev[j] + 1, row[j-1] + 1, prev[j-1] + cost)
+            if (i > 1) and (j > 1) and (s1[i-1] == s2[j-2]) and (s1[i-2] == s2[j-1]):
+                row[j] = min(row[j], prev2[j-2] + 1)
+        if (not max_distance is None) and (min(row) > max_distance):
+            return None
+        prev2, prev = prev, row
+
+    d = prev[-1]
+    if (not max_distance is None) and (d > max_distance):
+        return None
+    return d
+
+
+class FuzzyNameIndex():
+    """
+    SymSpell-style deletion index over the tokens of names, returns the indexed names within an edit distance of a query
+    """
+
+    def __init__(self, max_distance=2, prefix_length=7):
+        self.max_distance = max_distance
+        self.prefix_length = prefix_length
+        self.normalised_names = {}  # normalised name -> set of names
+        self.token_names = {}  # token -> set of normalised names with that token
+        self.deletes = {}  # deletion variant of a token prefix -> set of tokens
+
+    @classmethod
+    def build(cls, names, max_distance=2, prefix_length=7):
+        index = cls(max_distance=max_distance, prefix_length=prefix_length)
+        for name in tqdm(names, leave=True, position=0, desc='Fuzzy name index'):
+            index.add(name)
+        return index
+
+    def add(self, name):
+        n = normalise_name(name)
+        if not n:
+            return
+        if not n in self.normalised_names:
+            self.normalised_names[n] = set()
+            for t in n.split(' '):
+                if not t in self.token_names:
+                    self.token_names[t] = set()
+                    for d in name_deletes(t, max_distance=self.max_distance, prefix_length=self.prefix_length):
+                        self.deletes.setdefault(d, set()).add(t)
+                self.token_names[t].add(n)
+        self.normalised_names[n].add(name)
+
+    def similar_tokens(self, t, max_distance):
+        tokens = set()
+        for d in name_deletes(t, max_distance=max_distance, prefix_length=self.prefix_length):
+            if d in self.deletes:
+                tokens.update(self.deletes[d])
+        return {token for token in tokens if not edit_distance(t, token, max_distance=max_distance) is None}
+
+    def query(self, q, max_distance=None):
+        # returns [(name, distance)], closest first
+        if max_distance is None or max_distance > self.max_distance:
+            max_distance = self.max_distance
+
+        q = normalise_name(q)
+        if not q:
+            return []
+
+        # a match has a token close to each query token, so only the names of the rarest query token are compared (salt words like 'acetate' are shared by many names)
+        candidate_tokens, n_candidates = None, None
+        for t in set(q.split(' ')):
+            tokens = self.similar_tokens(t, max_distance)
+            n = sum(len(self.token_names[x]) for x in tokens)
+            if (n_candidates is None) or (n < n_candidates):
+                candidate_tokens, n_candidates = tokens, n
+
+        candidates = set()
+        for t in candidate_tokens:
+            candidates.update(self.token_names[t])
+
+        r = []
+        for n in candidates:
+            distance = edit_distance(q, n, max_distance=max_distance)
+            if not distance is None:
+                r.extend((name, distance) for name in self.normalised_names[n])
+
+        return sorted(r, key=lambda x:(x[1], x[0]))
+
+    def save(self, fn):
+        # the token and deletion indexes are stored too so loading doesn't regenerate them
+        with open(f"{fn}.tmp", 'wb') as f:
+            pickle.dump({
+                'max_distance': self.max_distance, 
+                'prefix_length': self.prefix_length, 
+                'normalised_names': self.normalised_names, 
+                'token_names': self.token_names, 
+                'deletes': self.deletes
+            }, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f"{fn}.tmp", fn)
+
+    @classmethod
+    def load(cls, fn):
+        with open(fn, 'rb') as f:
+            data = pickle.load(f)
+        index = cls(max_distance=data['max_distance'], prefix_length=data['prefix_length'])
+        index.normalised_names = data['normalised_names']
+        index.token_names = data['token_names']
+        index.deletes = data['deletes']
+        return index
@@ -2,153 +2,317 @@ from tqdm.auto import tqdm
 import json
 import pickle
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 
+import os
 import zipfile
+import hashlib
 import io
 import gzip
-import re
 
 import chembl_structure_pipeline as csp  # https://github.com/chembl/ChEMBL_Structure_Pipeline.git
 import rdkit
 
+from .gsrs_store import GsrsStore
+
+def molblock2inchi(molblock):
+    try:
+        mol = rdkit.Chem.MolFromMolBlock(molblock)
+        return rdkit.Chem.MolToInchi(mol)
+    except:
+        return None
+
+def standardise_molblock(molblock):
+    issues = csp.checker.check_molblock(molblock)
+
+    standardised_molblock = csp.standardizer.standardize_molblock(molblock)  # standardise
+    parent_molblock = csp.standardizer.get_parent_molblock(molblock)  # get parent
+
+    return {
+        'raw': molblock,
+        'standardised': standardised_molblock,
+        'parent': parent_molblock,
+        'issues': issues
+    }
+
+def molblock_inchis(d):
+    # filter the issues out
+    if max([0]+[i[0] for i in d['issues']]) > 2: 
+        return None
+
+    # generate InChiKeys
+    inchis = {k:molblock2inchi(v) for k,v in d.items()}
+    return {k:v for k,v in inchis.items() if (k in {'raw', 'standardised', 'parent'}) and v}
+
+def standardise_entry(molblock):
+    # everything derived from a molblock, in the form kept by the structure cache
+    d = standardise_molblock(molblock)
+    return {
+        'standardised': d['standardised'], 
+        'parent': d['parent'], 
+        'issues': d['issues'], 
+        'inchis': molblock_inchis(d)
+    }
+
+def standardise_chunk(chunk):
+    # module level so it can be sent to worker processes
+    rdkit.RDLogger.DisableLog('rdApp.*')
+    return [(unii, standardise_entry(molblock)) for unii, molblock in chunk]
+
 class GsrsIndex():
     """
     Data downloaded from https://gsrs.ncats.nih.gov/#/
     """
     
-    def __init__(self, data_dir='.'):
+    def __init__(self, data_dir='.', backend='json', structure_cache=None):
         rdkit.RDLogger.DisableLog('rdApp.*')
         
         self.data_dir = data_dir
+        self.backend = backend  # 'json' loads everything into memory, 'sqlite' fetches single records on demand
+        self.gsrs_store = None
+        self.code_index = None
+        self.unii2chembl = None
+        self.structure_cache = structure_cache  # optional StructureCache consulted before standardising
         
         try:
             self.load_indexes()
         except:
             self.gsrs_dict = None
             self.gsrs_inchis = None
+            self.gsrs_hashes = None
         
-    def fetch_data(self, fn, data_dir=None):
+    def iter_records(self, fn, data_dir=None):
+        # stream the records out of the zipped, gzipped dump one line at a time
         if data_dir is None:
             data_dir = self.data_dir
         
-        gsrs_records = []
         with open(f'{data_dir}/{fn}', 'rb') as f:
             gsrs_zipfile = zipfile.ZipFile(f, 'r')
             for fp in gsrs_zipfile.filelist:
                 if fp.filename.split('/')[-1] == 'smallSeedData.gsrs':
-                    gsrs_datafile = gsrs_zipfile.read(fp)
+                    with gsrs_zipfile.open(fp) as gsrs_datafile:
+                        with gzip.GzipFile(fileobj=gsrs_datafile) as gsrs_data:
+                            for line in io.TextIOWrapper(gsrs_data, encoding='latin-1', newline='\n'):
+                                line = line.rstrip('\n')
+                                if line:
+                                    line = '{' + '{'.join(line.split('{')[1:])
+                                    yield json.loads(line)
+                    break
+    
+    @staticmethod
+    def project_record(gr):
+        # reduce a raw GSRS record to the fields we index, None if the record is filtered out
+        if gr['substanceClass'] in {'concept'}:
+            return None
+        if not gr['status'] in {'approved'}:
+            return None
+        
+        substance_class = gr['substanceClass']
+        definition_level = gr['definitionLevel']
+        names = [(n['name'], n['type']) for n in gr['names']]
+        codes = defaultdict(set)
+        for n in gr['codes']:
+            try:
+                codes[n['codeSystem']].add((n['type'], n['code']))
+            except KeyError as e:
+                pass
+                
+        try: 
+            structure = {
+                'molfile': gr['structure']['molfile'],
+                'atropisomerism': gr['structure']['atropisomerism'],
+                'stereoCenters': gr['structure']['stereoCenters'],
+                'definedStereo': gr['structure']['definedStereo'],
+                'ezCenters': gr['structure']['ezCenters'],
+                'charge': gr['structure']['charge'],
+                'stereochemistry': gr['structure']['stereochemistry']
+            }
+        except: 
+            structure = {}
 
-            gsrs_data = gzip.open(io.BytesIO(gsrs_datafile)).read().decode('latin-1')
+        relationships = []
+        for r in gr['relationships']:
+            if 'approvalID' in r['relatedSubstance']:
+                relationships.append((r['relatedSubstance']['approvalID'], r['type']))
 
-            for line in tqdm(re.split('\n', gsrs_data)):
-                if line:
-                    line = '{' + '{'.join(line.split('{')[1:])
-                    gsrs_records.append(json.loads(line))
-        
+        return {
+            'substance_class': substance_class, 
+            'definition_level': definition_level, 
+            'names': names, 
+            'codes': {k:sorted(vs, key=str) for k,vs in codes.items()},  # sorted so the record hash is stable
+            'structure': structure, 
+            'relationships': relationships
+        }
+    
+    def fetch_data(self, fn, data_dir=None):
+        # records are parsed, filtered and projected one at a time so the raw dump is never held in memory
         self.gsrs_dict = {}
-        for gr in gsrs_records:
-            if gr['substanceClass'] in {'concept'}:
+        for gr in tqdm(self.iter_records(fn, data_dir=data_dir), leave=True, position=0, desc='GSRS records'):
+            record = self.project_record(gr)
+            if record is None:
                 continue
-            if not gr['status'] in {'approved'}:
-                continue
-
-            unii = gr['approvalID']
-            substance_class = gr['substanceClass']
-            definition_level = gr['definitionLevel']
-            names = [(n['name'], n['type']) for n in gr['names']]
-            codes = defaultdict(set)
-            for n in gr['codes']:
-                try:
-                    codes[n['codeSystem']].add((n['type'], n['code']))
-                except KeyError as e:
-                    pass
-                    
-            try: 
-                structure = {
-                    'molfile': gr['structure']['molfile'],
-                    'atropisomerism': gr['structure']['atropisomerism'],
-                    'stereoCenters': gr['structure']['stereoCenters'],
-                    'definedStereo': gr['structure']['definedStereo'],
-                    'ezCenters': gr['structure']['ezCenters'],
-                    'charge': gr['structure']['charge'],
-                    'stereochemistry': gr['structure']['stereochemistry']
-                }
-            except: 
-                structure = {}
-
-            relationships = []
-            for r in gr['relationships']:
-                if 'approvalID' in r['relatedSubstance']:
-                    relationships.append((r['relatedSubstance']['approvalID'], r['type']))
-
-            self.gsrs_dict[unii] = {
-                'substance_class': substance_class, 
-                'definition_level': definition_level, 
-                'names': names, 
-                'codes': {k:list(vs) for k,vs in codes.items()}, 
-                'structure': structure, 
-                'relationships': relationships
-            }
+            
+            self.gsrs_dict[gr['approvalID']] = record
+        
+        self.code_index = None
+        self.unii2chembl = None
+        self.gsrs_hashes = {unii:self.record_hash(record) for unii,record in self.gsrs_dict.items()}
     
-    def gen_inchi_index(self):
-        def molblock2inchi(molblock):
-            try:
-                mol = rdkit.Chem.MolFromMolBlock(molblock)
-                return rdkit.Chem.MolToInchi(mol)
-            except:
-                return None
+    @staticmethod
+    def record_hash(record):
+        # hash of the projected record (molfile included), stable across a JSON save/load round trip
+        return hashlib.sha1(json.dumps(record, sort_keys=True).encode('utf-8')).hexdigest()
     
-        gsrs_mol = {}
-        no_struct = []
-        for k,v in tqdm(self.gsrs_dict.items(), leave=True, position=0, desc='Standardising MolFiles'):
-            issues = None
-            if 'molfile' in v['structure']:
-                molblock = v['structure']['molfile']
-            else:
-                no_struct.append(k)
-                continue
-
-            issues = csp.checker.check_molblock(molblock)
-
-            standardised_molblock = csp.standardizer.standardize_molblock(molblock)  # standardise
-            parent_molblock = csp.standardizer.get_parent_molblock(molblock)  # get parent
-
-            gsrs_mol[k] = {
-                'raw': molblock,
-                'standardised': standardised_molblock,
-                'parent': parent_molblock,
-                'issues': issues
-            }
+    def standardise(self, molblocks, n_workers=1, chunk_size=1000):
+        # molblocks is a list of (unii, molblock), the result keeps the input order
+        entries = {}
+        if not self.structure_cache is None:
+            cached = self.structure_cache.get_many('gsrs_molblock', [molblock for unii, molblock in molblocks])
+            entries.update((unii, cached[molblock]) for unii, molblock in molblocks if molblock in cached)
         
-        self.gsrs_inchis = {}
-        for unii,d in tqdm(gsrs_mol.items(), leave=True, position=0, desc='Converting to InChI'):
-            # filter the issues out
-            if max([0]+[i[0] for i in d['issues']]) > 2: 
-                continue
-
-            # generate InChiKeys
-            self.gsrs_inchis[unii] = {k:molblock2inchi(v) for k,v in d.items()}
-
-        for unii,d in self.gsrs_inchis.items():
-             self.gsrs_inchis[unii] = {k:v for k,v in d.items() if (k in {'raw', 'standardised', 'parent'}) and v}
+        todo = [(unii, molblock) for unii, molblock in molblocks if not unii in entries]
+        chunks = [todo[i:i+chunk_size] for i in range(0, len(todo), chunk_size)]
+        
+        molblock_dict = dict(molblocks)
+        def add_results(r):
+            entries.update(r)
+            if not self.structure_cache is None:
+                self.structure_cache.set_many('gsrs_molblock', [(molblock_dict[unii], entry) for unii, entry in r])
+        
+        if n_workers is None or n_workers > 1:
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                for r in tqdm(executor.map(standardise_chunk, chunks), total=len(chunks), leave=True, position=0, desc='Standardising MolFiles'):
+                    add_results(r)
+        else:
+            for chunk in tqdm(chunks, leave=True, position=0, desc='Standardising MolFiles'):
+                add_results(standardise_chunk(chunk))
+        
+        gsrs_inchis = {}
+        for unii, molblock in molblocks:
+            inchis = entries[unii]['inchis']
+            if inchis is not None:
+                gsrs_inchis[unii] = inchis
+        
+        return gsrs_inchis
+    
+    def gen_inchi_index(self, n_workers=1, chunk_size=1000):
+        # n_workers=None uses one process per CPU
+        molblocks = [(k, v['structure']['molfile']) for k,v in self.gsrs_dict.items() if 'molfile' in v['structure']]
+        self.gsrs_inchis = self.standardise(molblocks, n_workers=n_workers, chunk_size=chunk_size)
+    
+    def update_indexes(self, fn, data_dir=None, n_workers=1, chunk_size=1000):
+        # rebuild from a new dump, only re-standardising records that were added or changed
+        old_hashes = self.gsrs_hashes if self.gsrs_hashes is not None else {}
+        old_inchis = self.gsrs_inchis if self.gsrs_inchis is not None else {}
+        
+        self.fetch_data(fn, data_dir=data_dir)
+        
+        changed = {unii for unii,h in self.gsrs_hashes.items() if old_hashes.get(unii) != h}
+        deleted = set(old_hashes.keys()) - set(self.gsrs_hashes.keys())
+        
+        molblocks = [(k, self.gsrs_dict[k]['structure']['molfile']) for k in self.gsrs_dict.keys() if (k in changed) and ('molfile' in self.gsrs_dict[k]['structure'])]
+        new_inchis = self.standardise(molblocks, n_workers=n_workers, chunk_size=chunk_size)
+        
+        gsrs_inchis = {}
+        for unii in self.gsrs_dict.keys():
+            if unii in changed:
+                if unii in new_inchis:
+                    gsrs_inchis[unii] = new_inchis[unii]
+            elif unii in old_inchis:
+                gsrs_inchis[unii] = old_inchis[unii]
+        self.gsrs_inchis = gsrs_inchis
+        
+        return {
+            'added': len(changed - set(old_hashes.keys())), 
+            'changed': len(changed & set(old_hashes.keys())), 
+            'deleted': len(deleted), 
+            'unchanged': len(self.gsrs_dict) - len(changed)
+        }
+    
+    def gen_code_index(self):
+        # reverse index of the GSRS codes, codeSystem -> code -> UNIIs and UNII -> ChEMBL IDs
+        code_index = defaultdict(lambda :defaultdict(set))
+        unii2chembl = defaultdict(list)
+        for unii, record in tqdm(self.gsrs_dict.items(), leave=True, position=0, desc='GSRS code index'):
+            for code_system, codes in record['codes'].items():
+                for code_type, code in codes:
+                    code_index[code_system][code].add(unii)
+                    if code_system == 'ChEMBL':
+                        unii2chembl[unii].append((code_type, code))
+        
+        self.code_index = {k1:{k2:sorted(v2) for k2,v2 in v1.items()} for k1,v1 in code_index.items()}
+        self.unii2chembl = {unii:[code for code_type, code in sorted(codes, key=lambda x:(x[0] != 'PRIMARY', str(x)))] for unii,codes in unii2chembl.items()}  # primary codes first
+        
+        return self.code_index, self.unii2chembl
+    
+    def save_code_index(self, data_dir=None):
+        if data_dir is None:
+            data_dir = self.data_dir
+        
+        if self.code_index is None:
+            self.gen_code_index()
+        
+        with open(f"{data_dir}/gsrs_codes.json", 'wt') as f:
+            json.dump({'code_index': self.code_index, 'unii2chembl': self.unii2chembl}, f)
+    
+    def load_code_index(self, data_dir=None):
+        if data_dir is None:
+            data_dir = self.data_dir
+        
+        with open(f"{data_dir}/gsrs_codes.json", 'rt') as f:
+            d = json.load(f)
+        self.code_index = d['code_index']
+        self.unii2chembl = d['unii2chembl']
     
     def save_indexes(self, data_dir=None):
         if data_dir is None:
             data_dir = self.data_dir
+        
+        self.save_code_index(data_dir=data_dir)
+        
+        if self.backend == 'sqlite':
+            GsrsStore.write(f"{data_dir}/gsrs_store.sqlite", self.gsrs_dict, self.gsrs_inchis, self.gsrs_hashes)
+            return
             
         with open(f"{data_dir}/gsrs_dict.json", 'wt') as f:
             json.dump(self.gsrs_dict, f)
         with open(f"{data_dir}/gsrs_inchis.json", 'wt') as f:
             json.dump(self.gsrs_inchis, f)
+        with open(f"{data_dir}/gsrs_hashes.json", 'wt') as f:
+            json.dump(self.gsrs_hashes, f)
         
     def load_indexes(self, data_dir=None):
         if data_dir is None:
             data_dir = self.data_dir
+        
+        try:
+            self.load_code_index(data_dir=data_dir)
+        except FileNotFoundError:
+            # generated from gsrs_dict on first use
+            self.code_index = None
+            self.unii2chembl = None
+        
+        if self.backend == 'sqlite':
+            if not os.path.exists(f"{data_dir}/gsrs_store.sqlite"):
+                raise FileNotFoundError(f"{data_dir}/gsrs_store.sqlite")
+            if not self.gsrs_store is None:
+                self.gsrs_store.close()
+            self.gsrs_store = GsrsStore(f"{data_dir}/gsrs_store.sqlite")
+            self.gsrs_dict = self.gsrs_store.records
+            self.gsrs_inchis = self.gsrs_store.inchis
+            self.gsrs_hashes = self.gsrs_store.hashes
+            return
             
         with open(f"{data_dir}/gsrs_dict.json", 'rt') as f:
             self.gsrs_dict = json.load(f)
         with open(f"{data_dir}/gsrs_inchis.json", 'rt') as f:
             self.gsrs_inchis = json.load(f)
+        try:
+            with open(f"{data_dir}/gsrs_hashes.json", 'rt') as f:
+                self.gsrs_hashes = json.load(f)
+        except FileNotFoundError:
+            # indexes saved before hashes were stored
+            self.gsrs_hashes = {unii:self.record_hash(record) for unii,record in self.gsrs_dict.items()}
             
     def query(self, unii):
         return self.gsrs_dict[unii]
@@ -156,4 +320,19 @@ class GsrsIndex():
     def get_inchi(self, unii):
         if unii in self.gsrs_inchis:
             return self.gsrs_inchis[unii]
+    
+    def query_code(self, code_system, code):
+        if self.code_index is None:
+            self.gen_code_index()
+        
+        if code_system in self.code_index:
+            if code in self.code_index[code_system]:
+                return self.code_index[code_system][code]
+    
+    def get_chembl_ids(self, unii):
+        if self.unii2chembl is None:
+            self.gen_code_index()
+        
+        if unii in self.unii2chembl:
+            return self.unii2chembl[unii]
         
@@ -0,0 +1,111 @@
+import json
+import os
+import sqlite3
+import threading
+from collections.abc import Mapping
+
+
+class GsrsStoreTable(Mapping):
+    """
+    Read-only dict-like view of one column of the GSRS store, rows are fetched on demand and kept once looked up
+    """
+
+    def __init__(self, store, column, decode=json.loads):
+        self.store = store
+        self.column = column
+        self.decode = decode
+        self.cache = {}
+
+    def __getitem__(self, unii):
+        if unii in self.cache:
+            return self.cache[unii]
+
+        row = self.store.fetchone(f"select {self.column} from gsrs where unii = ? and {self.column} is not null", (unii,))
+        if row is None:
+            raise KeyError(unii)
+
+        v = self.decode(row[0])
+        self.cache[unii] = v
+        return v
+
+    def __iter__(self):
+        for unii, in self.store.iterate(f"select unii from gsrs where {self.column} is not null order by rowid"):
+            yield unii
+
+    def __len__(self):
+        return self.store.fetchone(f"select count(*) from gsrs where {self.column} is not null")[0]
+
+    def items(self):
+        # streams the column without filling the cache
+        for unii, v in self.store.iterate(f"select unii, {self.column} from gsrs where {self.column} is not null order by rowid"):
+            yield unii, self.decode(v)
+
+
+class GsrsStore():
+    """
+    SQLite backed store of the GSRS indexes, one row per UNII holding the projected record, InChIs and record hash
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+
+        self.records = GsrsStoreTable(self, 'record')
+        self.inchis = GsrsStoreTable(self, 'inchis')
+        self.hashes = GsrsStoreTable(self, 'hash', decode=str)
+
+    def fetchone(self, sql, params=()):
+        with self.lock:
+            return self.connection.execute(sql, params).fetchone()
+
+    def fetchall(self, sql, params=()):
+        with self.lock:
+            return self.connection.execute(sql, params).fetchall()
+
+    def iterate(self, sql, params=(), batch_size=10000):
+        # rows in batches, the lock is only held while a batch is fetched so lookups can run between batches
+        with self.lock:
+            cursor = self.connection.execute(sql, params)
+        try:
+            while True:
+                with self.lock:
+                    batch = cursor.fetchmany(batch_size)
+                if not batch:
+                    break
+                yield from batch
+        finally:
+            cursor.close()
+
+    def close(self):
+        self.connection.close()
+
+    @staticmethod
+    def write(path, gsrs_dict, gsrs_inchis, gsrs_hashes=None, batch_size=10000):
+        def rows():
+            for unii, record in gsrs_dict.items():
+                inchis = gsrs_inchis[unii] if unii in gsrs_inchis else None
+                h = gsrs_hashes[unii] if (gsrs_hashes is not None) and (unii in gsrs_hashes) else None
+                yield (unii, json.dumps(record), None if inchis is None else json.dumps(inchis), h)
+
+        # write to a temporary file and swap it in, so open readers keep a consistent store
+        tmp_path = f"{path}.tmp"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+        connection = sqlite3.connect(tmp_path)
+        connection.execute("create table gsrs (unii text primary key, record text, inchis text, hash text)")
+
+        batch = []
+        for row in rows():
+            batch.append(row)
+            if len(batch) >= batch_size:
+                connection.executemany("insert into gsrs values (?, ?, ?, ?)", batch)
+                batch = []
+        if batch:
+            connection.executemany("insert into gsrs values (?, ?, ?, ?)", batch)
+
+        connection.commit()
+        connection.close()
+
+        os.replace(tmp_path, path)
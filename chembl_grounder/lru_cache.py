@@ -0,0 +1,55 @@
+import threading
+from collections import OrderedDict
+
+
+class LRUCache():
+    """
+    Bounded, thread-safe memo with least-recently-used eviction and hit/miss counters
+    """
+
+    missing = object()
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self.data:
+                self.data.move_to_end(key)
+                self.hits += 1
+                return self.data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        if not self.maxsize:
+            return
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def get_or_compute(self, key, f):
+        # f is called outside the lock, so two threads may compute the same missing key
+        v = self.get(key, default=self.missing)
+        if v is self.missing:
+            v = f()
+            self.put(key, v)
+        return v
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.data), 'maxsize': self.maxsize}
@@ -0,0 +1,88 @@
+import json
+import hashlib
+import sqlite3
+import threading
+import importlib.metadata
+
+
+def pipeline_versions():
+    # a cache that can't tell when chembl_structure_pipeline changes would keep stale entries, so an unknown version is an error
+    import rdkit
+    try:
+        csp_version = importlib.metadata.version('chembl_structure_pipeline')
+    except importlib.metadata.PackageNotFoundError:
+        raise ValueError("Can't determine the chembl_structure_pipeline version, pass versions to StructureCache explicitly")
+
+    return {'rdkit': rdkit.__version__, 'chembl_structure_pipeline': csp_version}
+
+
+class StructureCache():
+    """
+    On-disk memo of structure conversions (standardisation, parent, checker issues, InChI, fragments), keyed by a hash of the input.
+    Entries are dropped when the RDKit or chembl_structure_pipeline version changes.
+    """
+
+    def __init__(self, path, versions=None):
+        # versions defaults to pipeline_versions(), which raises ValueError if the chembl_structure_pipeline version is unknown
+        self.path = path
+        self.versions = pipeline_versions() if versions is None else versions
+        self.hits = 0
+        self.misses = 0
+
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("create table if not exists meta (key text primary key, value text)")
+        self.connection.execute("create table if not exists cache (kind text, key text, value text, primary key (kind, key))")
+
+        row = self.connection.execute("select value from meta where key = 'versions'").fetchone()
+        if (row is None) or (json.loads(row[0]) != self.versions):
+            self.connection.execute("delete from cache")
+            self.connection.execute("insert or replace into meta values ('versions', ?)", (json.dumps(self.versions),))
+        self.connection.commit()
+
+    @staticmethod
+    def key_hash(s):
+        return hashlib.sha1(s.encode('utf-8')).hexdigest()
+
+    def get(self, kind, s):
+        with self.lock:
+            row = self.connection.execute("select value from cache where kind = ? and key = ?", (kind, self.key_hash(s))).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(row[0])
+
+    def get_many(self, kind, ss, batch_size=500):
+        # returns {input: value} for the inputs found in the cache
+        ss = list(set(ss))
+        r = {}
+        for i in range(0, len(ss), batch_size):
+            keys = {self.key_hash(s):s for s in ss[i:i+batch_size]}
+            with self.lock:
+                rows = self.connection.execute(
+                    f"select key, value from cache where kind = ? and key in ({','.join('?'*len(keys))})",
+                    (kind, *keys.keys())
+                ).fetchall()
+            for k,v in rows:
+                r[keys[k]] = json.loads(v)
+        self.hits += len(r)
+        self.misses += len(ss) - len(r)
+        return r
+
+    def set(self, kind, s, value):
+        self.set_many(kind, [(s, value)])
+
+    def set_many(self, kind, items):
+        with self.lock:
+            self.connection.executemany(
+                "insert or replace into cache values (?, ?, ?)",
+                ((kind, self.key_hash(s), json.dumps(v)) for s,v in items)
+            )
+            self.connection.commit()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def close(self):
+        self.connection.close()